@@ -1,10 +1,15 @@
 import struct
+import asyncio
 import hashlib
+import logging
 import xml.etree.ElementTree as ElementTree
 
+logger = logging.getLogger(__name__)
+
 BAICHUAN_MAGIC = 0x0abcdef0
 BAICHUAN_MESSAGE_ID_LOGIN = 0x01
 BAICHUAN_MESSAGE_ID_VIDEO = 0x03
+BAICHUAN_MESSAGE_ID_VIDEO_STOP = 0x04
 BAICHUAN_MESSAGE_ID_VIDEO_INPUT = 0x4e
 BAICHUAN_MESSAGE_ID_PING = 0x5d
 BAICHUAN_MESSAGE_ID_BATTERY_INFO = 0xfc
@@ -12,6 +17,10 @@ BAICHUAN_MESSAGE_ID_BATTERY_INFO = 0xfc
 MAINSTREAM = "mainStream"
 SUBSTREAM = "subStream"
 
+XML_KEY = [0x1F, 0x2D, 0x3C, 0x4B, 0x5A, 0x69, 0x78, 0xFF]
+# The xml key xored with the low byte of the encryption offset, precomputed for every possible low byte
+XML_KEYSTREAMS = [bytes([key ^ offset_byte for key in XML_KEY]) for offset_byte in range(256)]
+
 MESSAGE_CLASS_TO_HEADER_LENGTH = {
   0x6514:20,
   0x6614:20,
@@ -26,16 +35,19 @@ class BaichuanControlLayer:
         self.udp_layer = udp_layer
         self.encryption_offset = 0
         self.modern_message_id_to_binary_mode = {}
-        self.recv_buffer = b''
+        # Header fields, reassembly buffer and received length of the message which is currently being received
+        self.recv_message = None
+        self.received_messages = asyncio.Queue()
+        self.udp_layer.set_packet_handler(self._handle_udp_packet)
     
     @staticmethod
     def xml_decrypt(message, offset):
-        xml_key = [0x1F, 0x2D, 0x3C, 0x4B, 0x5A, 0x69, 0x78, 0xFF]
-        result = b''
-        for i in range(len(message)):
-            val = (message[i] ^ xml_key[(i + offset) % 8]) ^ (offset & 0xFF)
-            result += bytes([val])
-        return result
+        length = len(message)
+        if length == 0:
+            return b''
+        xml_key = XML_KEYSTREAMS[offset & 0xFF]
+        keystream = (xml_key * (length // 8 + 2))[offset % 8:offset % 8 + length]
+        return (int.from_bytes(message, 'little') ^ int.from_bytes(keystream, 'little')).to_bytes(length, 'little')
     
     @staticmethod
     def md5_hash(str, zero_last):
@@ -94,13 +106,19 @@ class BaichuanControlLayer:
         self.udp_layer.send_packet(login_message_buffer)
 
     def start_video(self, stream):
+        self._send_preview_message(BAICHUAN_MESSAGE_ID_VIDEO, stream)
+
+    def stop_video(self, stream):
+        self._send_preview_message(BAICHUAN_MESSAGE_ID_VIDEO_STOP, stream)
+
+    def _send_preview_message(self, modern_message_id, stream):
         xml_body = f"<?xml version=\"1.0\" encoding=\"UTF-8\" ?>\n<body>\n<Preview version=\"1.1\">\n<channelId>0</channelId>\n<handle>0</handle>\n<streamType>{stream}</streamType>\n</Preview>\n</body>\n"
         xml_bytes = xml_body.encode("utf-8")
         encrypted_xml_body = self.xml_decrypt(xml_bytes, self.encryption_offset)
 
         video_message_header = b''
         video_message_header += BAICHUAN_MAGIC.to_bytes(4, 'little')
-        video_message_header += BAICHUAN_MESSAGE_ID_VIDEO.to_bytes(4, 'little')
+        video_message_header += modern_message_id.to_bytes(4, 'little')
         video_message_header += len(encrypted_xml_body).to_bytes(4, 'little')
         video_message_header += self.encryption_offset.to_bytes(4, 'little')
         video_message_header += bytes([0x00, 0x00])
@@ -128,59 +146,69 @@ class BaichuanControlLayer:
     def has_bin_offset(message_class):
         return message_class == 0x6414 or message_class == 0x0000
     
-    def _recv_next_udp_packet(self):
-        packet = None
-        if len(self.recv_buffer) > 0:
-            packet = self.recv_buffer
-            self.recv_buffer = b''
-        else:
-            packet = self.udp_layer.recv_packet()
-        return packet
-
     def set_binary_mode(self, modern_message_id, binary_mode):
         self.modern_message_id_to_binary_mode[modern_message_id] = binary_mode
     
     def is_in_binary_mode(self, modern_message_id):
         return (modern_message_id in self.modern_message_id_to_binary_mode) and self.modern_message_id_to_binary_mode[modern_message_id]
     
-    def recv_packet(self):
-        modern_message_id = None
-        message_class = None
-        message = b''
-        binary_data = b''
+    def _start_message(self, packet):
+        if len(packet) < 20:
+            logger.debug("Dropping packet which is too short for a Baichuan header")
+            return None
+        (magic, modern_message_id, message_len, encryption_offset, encrypted, _, message_class) = struct.unpack_from("<iIIIBBH", packet)
+        if magic != BAICHUAN_MAGIC or message_class not in MESSAGE_CLASS_TO_HEADER_LENGTH or len(packet) < MESSAGE_CLASS_TO_HEADER_LENGTH[message_class]:
+            logger.debug("Dropping packet without a valid Baichuan header")
+            return None
+        self.encryption_offset = encryption_offset
+        header_len = MESSAGE_CLASS_TO_HEADER_LENGTH[message_class]
+        bin_offset = 0
+        if self.has_bin_offset(message_class):
+            (bin_offset, ) = struct.unpack_from("<I", packet, 20)
+            if bin_offset != 0:
+                self.set_binary_mode(modern_message_id, True)
+        # The message is reassembled in a buffer preallocated from the header's
+        # message length, so every datagram payload is copied exactly once
+        self.recv_message = {
+            "modern_message_id": modern_message_id,
+            "message_class": message_class,
+            "encrypted": encrypted,
+            "bin_offset": bin_offset,
+            "body": memoryview(bytearray(message_len)),
+            "received_len": 0,
+        }
+        return packet[header_len:]
+
+    def _handle_udp_packet(self, packet):
+        # Called by the udp layer for the payload of every CTRL packet in order.
+        # A payload can contain the end of one message and the start of the next one.
+        packet = memoryview(packet)
         while True:
-            packet = self._recv_next_udp_packet()
-            (magic, modern_message_id, message_len, encryption_offset, encrypted, _, message_class) = struct.unpack_from("<iIIIBBH", packet)
-            self.encryption_offset = encryption_offset
-            if magic != BAICHUAN_MAGIC:
-                break
-            header_len = MESSAGE_CLASS_TO_HEADER_LENGTH[message_class]
-            bin_offset = 0
-            if self.has_bin_offset(message_class):
-                (bin_offset, ) = struct.unpack_from("<I", packet[20:])
-                if bin_offset != 0:
-                    self.set_binary_mode(modern_message_id, True)
-            
-            max_packet_size = None
-            if self.is_in_binary_mode(modern_message_id):
-                if bin_offset != 0:
-                    message += packet[header_len:header_len+bin_offset]
-                max_packet_size = min(len(packet[header_len+bin_offset:]), message_len - len(message) - len(binary_data))
-                binary_data += packet[header_len+bin_offset:header_len+bin_offset+max_packet_size]
-            else:
-                max_packet_size = min(len(packet[header_len:]), message_len - len(message) - len(binary_data))
-                message += packet[header_len:header_len+max_packet_size]
-            self.recv_buffer += packet[header_len+max_packet_size:]
-
-            while len(message) + len(binary_data) < message_len:
-                packet = self._recv_next_udp_packet()
-                max_packet_size = min(len(packet), message_len - len(message) - len(binary_data))
-                if self.is_in_binary_mode(modern_message_id):
-                    binary_data += packet[:max_packet_size]
-                else:
-                    message += packet[:max_packet_size]
-                self.recv_buffer += packet[max_packet_size:]
-            break
+            if self.recv_message == None:
+                if len(packet) == 0:
+                    return
+                packet = self._start_message(packet)
+                if packet == None:
+                    return
+            body = self.recv_message["body"]
+            received_len = self.recv_message["received_len"]
+            max_packet_size = min(len(packet), len(body) - received_len)
+            body[received_len:received_len+max_packet_size] = packet[:max_packet_size]
+            self.recv_message["received_len"] = received_len + max_packet_size
+            packet = packet[max_packet_size:]
+            if self.recv_message["received_len"] >= len(body):
+                self._finish_message()
+
+    def _finish_message(self):
+        modern_message_id = self.recv_message["modern_message_id"]
+        message_class = self.recv_message["message_class"]
+        encrypted = self.recv_message["encrypted"]
+        body = self.recv_message["body"]
+        message_end = self.recv_message["bin_offset"] if self.is_in_binary_mode(modern_message_id) else len(body)
+        self.recv_message = None
+
+        message = bytes(body[:message_end])
+        binary_data = body[message_end:]
         if encrypted or message_class == 0x6414 and len(message) > 0:
             message = self.xml_decrypt(message, self.encryption_offset)
         try:
@@ -191,4 +219,10 @@ class BaichuanControlLayer:
                 self.set_binary_mode(modern_message_id, binary_data_element.text == "1")
         except:
             pass
-        return (modern_message_id, message_class, message, binary_data)
\ No newline at end of file
+        self.received_messages.put_nowait((modern_message_id, message_class, message, binary_data))
+
+    async def recv_packet(self):
+        return await asyncio.wait_for(self.received_messages.get(), self.udp_layer.timeout)
+
+    def recv_packet_nowait(self):
+        return self.received_messages.get_nowait()
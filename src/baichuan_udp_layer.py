@@ -1,9 +1,12 @@
-import math
+import time
 import random
 import socket
+import asyncio
+import zlib
 import struct
 import logging
 import xml.etree.ElementTree as ElementTree
+from collections import deque
 import netifaces;
 
 logger = logging.getLogger(__name__)
@@ -14,14 +17,52 @@ UDP_MESSAGE_ID_DISCOVERY = 0x2a87cf3a
 
 DISCOVERY_PORT_START=50000
 DISCOVERY_PORT_END=60000
+DEVICE_DISCOVERY_PORT = 2015
+P2P_RELAY_PORT = 9999
 
 CLIENT_OS = 'WIN'
+UDP_HEADER_LENGTH = 20
+RECV_BUFFER_SIZE = 4096
+RECV_BATCH_SIZE = 64
+DISCOVERY_QUEUE_SIZE = 64
+REORDER_WINDOW_SIZE = 128
+# Received packets are acknowledged after every ACK_EVERY_PACKETS packets
+# or ACK_DELAY_MS milliseconds, whichever comes first
+ACK_EVERY_PACKETS = 2
+ACK_DELAY_MS = 20
+ACK_STRUCT = struct.Struct("<IIIIiII")
+ACK_HEADER_STRUCT = struct.Struct("<iIiiiiI")
+CTRL_HEADER_STRUCT = struct.Struct("<IIIiI")
+CTRL_MAX_PAYLOAD_SIZE = 1330
+# At most SEND_WINDOW_SIZE sent packets may be unacknowledged, further packets wait in the send queue.
+# Unacknowledged packets are retransmitted after a timeout derived from the measured round trip time.
+SEND_WINDOW_SIZE = 64
+INITIAL_RTO = 0.5
+MIN_RTO = 0.1
+MAX_RTO = 4
+FAST_RETRANSMIT_DUPLICATE_ACKS = 3
 ETHERNET_MTU = 1350
 #TODO:Find the right interface for internet & local lan
 GATEWAYS = netifaces.gateways()
 DEFAULT_GATEWAY_ADDRESS = None if GATEWAYS == None or GATEWAYS['default'] == None else GATEWAYS['default'][netifaces.AF_INET]
 BINDING_IFACE_IP = '' if DEFAULT_GATEWAY_ADDRESS == None else netifaces.ifaddresses(DEFAULT_GATEWAY_ADDRESS[1])[netifaces.AF_INET][0]['addr']
 
+UDP_KEY = [
+    0x1f2d3c4b, 0x5a6c7f8d,
+    0x38172e4b, 0x8271635a,
+    0x863f1a2b, 0xa5c6f7d8,
+    0x8371e1b4, 0x17f2d3a5
+]
+
+# Results of previous discoveries, shared by all sessions, so a reconnect
+# first tries the last known device address and doesn't resolve the relays again
+DISCOVERY_CACHE_TTL = 600
+P2P_RELAY_CACHE_TTL = 3600
+UNICAST_DISCOVERY_ROUNDS = 5
+P2P_DISCOVERY_ROUNDS = 10
+discovery_cache = {}
+p2p_relay_cache = {"hosts": [], "resolved": None}
+
 P2P_RELAY_HOSTNAMES = [
     "p2p.reolink.com",
     "p2p1.reolink.com",
@@ -35,8 +76,13 @@ P2P_RELAY_HOSTNAMES = [
     "p2p9.reolink.com"
 ]
 
-class BaichuanUdpLayer:
-    def __init__(self, device_sid, client_id, communication_port=0):
+class BaichuanUdpLayer(asyncio.DatagramProtocol):
+    '''UDP transport of a single camera session, driven by an asyncio event loop.
+    It implements the datagram protocol interface, but instead of a datagram
+    transport (which allocates a new bytes object for every datagram) the socket
+    is registered as a reader on the loop and drained into a reusable buffer.
+    '''
+    def __init__(self, device_sid, client_id, communication_port=0, ack_every_packets=ACK_EVERY_PACKETS, ack_delay_ms=ACK_DELAY_MS):
         self.device_sid = device_sid
         self.client_id = client_id
         self.device_id = None
@@ -45,106 +91,177 @@ class BaichuanUdpLayer:
         self.connection_id = -1
         self.last_send_packet_id = 0
         self.last_received_packet_id = -1
-        self.wait_acknowledgement = 0
+        self.last_acknowledged_packet_id = -1
+        self.duplicate_ack_count = 0
+        self.smoothed_rtt = None
+        self.rtt_variation = None
+        self.rto = INITIAL_RTO
+        self.retransmission_count = 0
+        self.ack_every_packets = ack_every_packets
+        self.ack_delay = ack_delay_ms / 1000
+        self.unacknowledged_packet_count = 0
+        self.ack_deadline = None
         self.target_address = (None, None)
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         server_address = (BINDING_IFACE_IP, self.communication_port)
         self.socket.bind(server_address)
+        self.socket.setblocking(False)
         self.communication_port = self.socket.getsockname()[1]
+        # Seconds to wait for the next control message, replaces the blocking socket timeout
+        self.timeout = None
         self.unack_messages = {}
+        self.send_queue = deque()
+        self.recv_buffer = bytearray(RECV_BUFFER_SIZE)
+        self.reordered_packets = {}
+        self.reorder_stats = {
+            "reordered_packets": 0,
+            "max_depth": 0,
+            "gaps_filled": 0,
+            "last_gap_fill_latency": 0,
+            "max_gap_fill_latency": 0,
+        }
+        self.packet_handler = None
+        self.loop = None
+        self.timer_handle = None
+        self.timer_deadline = None
+        # Answers to the local discovery and to the P2P discovery are received separately, because both run at the same time
+        self.local_discovery_messages = None
+        self.p2p_discovery_messages = None
         #Generate new client ID to say the cammera that instance is a a new client to broadcast information
         self.tid = random.randint(0, 4000)
-        self.p2p_relay_hosts = self._lookup_available_p2p_hosts()
+        self.p2p_relay_hosts = []
+
+    async def open(self):
+        self.loop = asyncio.get_running_loop()
+        self.local_discovery_messages = asyncio.Queue(DISCOVERY_QUEUE_SIZE)
+        self.p2p_discovery_messages = asyncio.Queue(DISCOVERY_QUEUE_SIZE)
+        self.loop.add_reader(self.socket.fileno(), self._read_ready)
+
+    def close(self):
+        if self.timer_handle != None:
+            self.timer_handle.cancel()
+            self.timer_handle = None
+        if self.loop != None:
+            self.loop.remove_reader(self.socket.fileno())
+        self.socket.close()
+
+    def set_packet_handler(self, packet_handler):
+        '''Set the function which receives the payload of every CTRL packet in order.
+        The payload may point into the receive buffer and must be consumed before the handler returns.
+        '''
+        self.packet_handler = packet_handler
     
-    def _lookup_available_p2p_hosts(self):
-        relay_hosts = []
-        for hostname in P2P_RELAY_HOSTNAMES:
-            try:
-                host = socket.gethostbyname(hostname)
-                relay_hosts.append(host)
-            except socket.gaierror:
-                pass
-        return relay_hosts
+    async def _lookup_p2p_relay_host(self, hostname):
+        try:
+            address_infos = await self.loop.getaddrinfo(hostname, None, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            return address_infos[0][4][0]
+        except socket.gaierror:
+            return None
+
+    async def _lookup_available_p2p_hosts(self):
+        # The relays are only resolved when they are needed, all at once, and cached for all sessions
+        resolved = p2p_relay_cache["resolved"]
+        if resolved == None or time.monotonic() - resolved > P2P_RELAY_CACHE_TTL or len(p2p_relay_cache["hosts"]) == 0:
+            hosts = await asyncio.gather(*[self._lookup_p2p_relay_host(hostname) for hostname in P2P_RELAY_HOSTNAMES])
+            p2p_relay_cache["hosts"] = [host for host in hosts if host != None]
+            p2p_relay_cache["resolved"] = time.monotonic()
+        return p2p_relay_cache["hosts"]
+
+    async def _recv_discovery_message(self, discovery_messages, timeout):
+        return await asyncio.wait_for(discovery_messages.get(), timeout)
     
-    def discover_device(self):
-        self.socket.settimeout(0.2)
-        retry = 25
-        sender = (None, None)
-        client_id = None
-        while client_id != self.client_id and retry >= 0:
+    async def discover_device(self):
+        # The local discovery and the P2P discovery run at the same time, the first one which finds the camera wins
+        local_discovery = asyncio.ensure_future(self._discover_local_device())
+        p2p_discovery = asyncio.ensure_future(self.p2p_discover())
+        pending = {local_discovery, p2p_discovery}
+        p2p_exception = None
+        try:
+            while len(pending) > 0:
+                (done, pending) = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                if local_discovery in done:
+                    if local_discovery.exception() == None and local_discovery.result() != None:
+                        (self.device_id, self.target_address) = local_discovery.result()
+                        self.connection_id = -1
+                        self.timeout = 30
+                        return
+                    logger.info("Local discovery failed: %s", local_discovery.exception())
+                if p2p_discovery in done:
+                    p2p_exception = p2p_discovery.exception()
+                    if p2p_exception == None:
+                        return
+                    logger.info("P2P discovery failed: %s", p2p_exception)
+            raise Exception("Device discovery failed") from p2p_exception
+        finally:
+            local_discovery.cancel()
+            p2p_discovery.cancel()
+
+    async def _discover_local_device(self):
+        cached_discovery = discovery_cache.get(self.device_sid)
+        if cached_discovery != None and time.monotonic() - cached_discovery["discovered"] < DISCOVERY_CACHE_TTL:
+            host = cached_discovery["target_address"][0]
+            logger.info("Sending discovery packet to the last known address %s", host)
+            discovery = await self._wait_for_local_discovery(UNICAST_DISCOVERY_ROUNDS, lambda: self._send_discovery_unicast(host))
+            if discovery != None:
+                return discovery
+        logger.info("Sending discovery packets")
+        return await self._wait_for_local_discovery(25, self._send_discovery_broadcast)
+
+    async def _wait_for_local_discovery(self, rounds, send_discovery):
+        retry = rounds
+        while retry > 0:
             retry -= 1
-            logger.info("Sending discovery packet")
-            self._send_discovery_broadcast()
+            send_discovery()
             try:
-                data, sender = self.socket.recvfrom(4096)
-                (udp_message_id, size, unknown, tid, checksum) = struct.unpack_from("<iIIiI", data)
-                if udp_message_id != UDP_MESSAGE_ID_DISCOVERY:
-                    continue
-                message = data[20:20+size]
-                actual_checksum = self.calc_crc(message)
-                if checksum != actual_checksum:
-                    logger.warn("Invalid checksum - expected: %d actual: %d", checksum, actual_checksum)
-                    continue
-                message = self.de_or_encrypt_udp_message(message, tid).decode("utf-8")
-                xml_root = ElementTree.fromstring(message)
-                did_element = xml_root.find("D2C_C_R/did")
-                cid_element = xml_root.find("D2C_C_R/cid")
-                if did_element != None and cid_element != None: 
-                    self.device_id = int(did_element.text)
-                    client_id = int(cid_element.text)
-                else:
-                    continue
-            except socket.timeout:
+                (xml_root, sender) = await self._recv_discovery_message(self.local_discovery_messages, 0.2)
+            except asyncio.TimeoutError:
                 continue
-            logger.info("Received discovery packet answer from %s", sender[0])
-
-        if retry <= 0:
-            self.p2p_discover()
-        else:
-            self.target_address = sender
-            self.socket.settimeout(30)
+            did_element = xml_root.find("D2C_C_R/did")
+            cid_element = xml_root.find("D2C_C_R/cid")
+            if did_element != None and cid_element != None and int(cid_element.text) == self.client_id:
+                logger.info("Received discovery packet answer from %s", sender[0])
+                device_id = int(did_element.text)
+                discovery_cache[self.device_sid] = {
+                    "target_address": sender,
+                    "device_id": device_id,
+                    "discovered": time.monotonic(),
+                }
+                return (device_id, sender)
+        return None
     
-    def p2p_discover(self):
+    async def p2p_discover(self):
         logger.info("Send P2P Discovery message")
-        self.socket.settimeout(0.5) #P2P Discover can take more time to answer than locally
         register_address = (None, None)
         relay_address = (None, None)
         device_address = (None, None)
         log_address = (None, None)
         endpoint_address = (None, None)
-        index = -1
+        self.p2p_relay_hosts = await self._lookup_available_p2p_hosts()
+        if len(self.p2p_relay_hosts) == 0:
+            raise Exception("No P2P host available to register")
+        retry = P2P_DISCOVERY_ROUNDS
         while True:                
-            index += 1  
-            if index >= len(self.p2p_relay_hosts):
-                raise "No P2P host available to register"
-            host = self.p2p_relay_hosts[index]
-            self._send_p2p_discovery(host)
+            if retry <= 0:
+                raise Exception("No P2P host answered the discovery")
+            retry -= 1
+            # All relays are asked at once, the first answer is used
+            for host in self.p2p_relay_hosts:
+                self._send_p2p_discovery(host)
             try:
-                data, sender = self.socket.recvfrom(4096)
-                (udp_message_id, size, unknown, tid, checksum) = struct.unpack_from("<iIIiI", data)
-                if udp_message_id != UDP_MESSAGE_ID_DISCOVERY:
-                    continue
-                message = data[20:20+size]
-                actual_checksum = self.calc_crc(message)
-                if checksum != actual_checksum:
-                    logger.warn("Invalid checksum - expected: %d actual: %d", checksum, actual_checksum)
-                    continue
-                message = self.de_or_encrypt_udp_message(message, tid).decode("utf-8")
-                xml_root = ElementTree.fromstring(message)
-                register_address = (xml_root.find("M2C_Q_R/reg/ip"), xml_root.find("M2C_Q_R/reg/port"))
-                relay_address = (xml_root.find("M2C_Q_R/relay/ip"), xml_root.find("M2C_Q_R/relay/port"))
-                log_address = (xml_root.find("M2C_Q_R/log/ip"), xml_root.find("M2C_Q_R/log/port"))
-                endpoint_address = (xml_root.find("M2C_Q_R/t/ip"), xml_root.find("M2C_Q_R/t/port"))
-                if register_address[0] != None and relay_address[0] != None:
-                    register_address = (register_address[0].text, int(register_address[1].text))
-                    relay_address = (relay_address[0].text, int(relay_address[1].text))
-                    log_address = (log_address[0].text, int(log_address[1].text))
-                    endpoint_address = (endpoint_address[0].text, int(endpoint_address[1].text))
-                    break
-                else:
-                    continue
-            except socket.timeout:
+                #P2P Discover can take more time to answer than locally
+                (xml_root, sender) = await self._recv_discovery_message(self.p2p_discovery_messages, 0.5)
+            except asyncio.TimeoutError:
                 continue
+            register_address = (xml_root.find("M2C_Q_R/reg/ip"), xml_root.find("M2C_Q_R/reg/port"))
+            relay_address = (xml_root.find("M2C_Q_R/relay/ip"), xml_root.find("M2C_Q_R/relay/port"))
+            log_address = (xml_root.find("M2C_Q_R/log/ip"), xml_root.find("M2C_Q_R/log/port"))
+            endpoint_address = (xml_root.find("M2C_Q_R/t/ip"), xml_root.find("M2C_Q_R/t/port"))
+            if register_address[0] != None and relay_address[0] != None:
+                register_address = (register_address[0].text, int(register_address[1].text))
+                relay_address = (relay_address[0].text, int(relay_address[1].text))
+                log_address = (log_address[0].text, int(log_address[1].text))
+                endpoint_address = (endpoint_address[0].text, int(endpoint_address[1].text))
+                break
         logger.info("P2P - Register address found, %s:%d", register_address[0], register_address[1])
         client_id = None
         device_id = None
@@ -152,45 +269,35 @@ class BaichuanUdpLayer:
             self._send_p2p_register(register_address, relay_address)
             while device_id == None:
                 try:
-                    data, sender = self.socket.recvfrom(4096)
-                    (udp_message_id, size, unknown, tid, checksum) = struct.unpack_from("<iIIiI", data)
-                    if udp_message_id != UDP_MESSAGE_ID_DISCOVERY:
-                        continue
-                    message = data[20:20+size]
-                    actual_checksum = self.calc_crc(message)
-                    if checksum != actual_checksum:
-                        logger.warn("Invalid checksum - expected: %d actual: %d", checksum, actual_checksum)
-                        continue
-                    message = self.de_or_encrypt_udp_message(message, tid).decode("utf-8")
-                    xml_root = ElementTree.fromstring(message)
-                    device_address_element = (xml_root.find("R2C_T/dev/ip"), xml_root.find("R2C_T/dev/port"))
-                    cid_element = xml_root.find("R2C_T/cid")
-                    connection_id_element = xml_root.find("R2C_T/sid")
-                    connection_id_element = xml_root.find("D2C_T/sid") if connection_id_element == None else connection_id_element
-                    cid_element = xml_root.find("D2C_T/cid") if cid_element == None else cid_element
-                    device_element = xml_root.find("D2C_T/did")                    
-                    if device_element == None:
-                        device_element = xml_root.find("D2C_CFM/did")
-                        cid_element = xml_root.find("D2C_CFM/cid") if cid_element == None else cid_element
-                    if device_element == None:
-                        device_element = xml_root.find("D2C_DISC/did")
-                        cid_element = xml_root.find("D2C_DISC/cid") if cid_element == None else cid_element
-
-                    if device_address_element[0] != None and cid_element != None and int(cid_element.text) == self.client_id and connection_id_element != None:
-                        device_address = (device_address_element[0].text, int(device_address_element[1].text))
-                        self.connection_id = int(connection_id_element.text)
-                        self.target_address = device_address
-                        self._send_p2p_local_connection()
-                        client_id = int(cid_element.text)
-                        if device_id != None:
-                            break
-                    if device_element != None and cid_element != None and int(cid_element.text) == self.client_id:
-                        device_id = int(device_element.text)
-                        client_id = int(cid_element.text)
-                        if device_address[0] != None:
-                            break
-                except socket.timeout:
+                    (xml_root, sender) = await self._recv_discovery_message(self.p2p_discovery_messages, 0.5)
+                except asyncio.TimeoutError:
                     continue
+                device_address_element = (xml_root.find("R2C_T/dev/ip"), xml_root.find("R2C_T/dev/port"))
+                cid_element = xml_root.find("R2C_T/cid")
+                connection_id_element = xml_root.find("R2C_T/sid")
+                connection_id_element = xml_root.find("D2C_T/sid") if connection_id_element == None else connection_id_element
+                cid_element = xml_root.find("D2C_T/cid") if cid_element == None else cid_element
+                device_element = xml_root.find("D2C_T/did")                    
+                if device_element == None:
+                    device_element = xml_root.find("D2C_CFM/did")
+                    cid_element = xml_root.find("D2C_CFM/cid") if cid_element == None else cid_element
+                if device_element == None:
+                    device_element = xml_root.find("D2C_DISC/did")
+                    cid_element = xml_root.find("D2C_DISC/cid") if cid_element == None else cid_element
+
+                if device_address_element[0] != None and cid_element != None and int(cid_element.text) == self.client_id and connection_id_element != None:
+                    device_address = (device_address_element[0].text, int(device_address_element[1].text))
+                    self.connection_id = int(connection_id_element.text)
+                    self.target_address = device_address
+                    self._send_p2p_local_connection()
+                    client_id = int(cid_element.text)
+                    if device_id != None:
+                        break
+                if device_element != None and cid_element != None and int(cid_element.text) == self.client_id:
+                    device_id = int(device_element.text)
+                    client_id = int(cid_element.text)
+                    if device_address[0] != None:
+                        break
         
         self.device_id = device_id
 
@@ -199,127 +306,257 @@ class BaichuanUdpLayer:
         self._send_p2p_remote_connection(log_address) #Announce we will connect locally
         self._send_p2p_dmap_connection(endpoint_address) #Announce we could connect remotely
 
-        self.socket.settimeout(1)
+        self.timeout = 1
         
 
-    @staticmethod    
+    @staticmethod
     def calc_crc(message):
-        table = [0x0, 0x0, 0x0, 0x0, 0x96, 0x30, 0x7, 0x77, 0x2C, 0x61, 0xE, 0xEE, 0xBA, 0x51, 0x9, 0x99, 0x19, 0xC4, 0x6D, 0x7, 0x8F, 0xF4, 0x6A, 0x70, 0x35, 0xA5, 0x63, 0xE9, 0xA3, 0x95, 0x64, 0x9E, 0x32, 0x88, 0xDB, 0xE, 0xA4, 0xB8, 0xDC, 0x79, 0x1E, 0xE9, 0xD5, 0xE0, 0x88, 0xD9, 0xD2, 0x97, 0x2B, 0x4C, 0xB6, 0x9, 0xBD, 0x7C, 0xB1, 0x7E, 0x7, 0x2D, 0xB8, 0xE7, 0x91, 0x1D, 0xBF, 0x90, 0x64, 0x10, 0xB7, 0x1D, 0xF2, 0x20, 0xB0, 0x6A, 0x48, 0x71, 0xB9, 0xF3, 0xDE, 0x41, 0xBE, 0x84, 0x7D, 0xD4, 0xDA, 0x1A, 0xEB, 0xE4, 0xDD, 0x6D, 0x51, 0xB5, 0xD4, 0xF4, 0xC7, 0x85, 0xD3, 0x83, 0x56, 0x98, 0x6C, 0x13, 0xC0, 0xA8, 0x6B, 0x64, 0x7A, 0xF9, 0x62, 0xFD, 0xEC, 0xC9, 0x65, 0x8A, 0x4F, 0x5C, 0x1, 0x14, 0xD9, 0x6C, 0x6, 0x63, 0x63, 0x3D, 0xF, 0xFA, 0xF5, 0xD, 0x8, 0x8D, 0xC8, 0x20, 0x6E, 0x3B, 0x5E, 0x10, 0x69, 0x4C, 0xE4, 0x41, 0x60, 0xD5, 0x72, 0x71, 0x67, 0xA2, 0xD1, 0xE4, 0x3, 0x3C, 0x47, 0xD4, 0x4, 0x4B, 0xFD, 0x85, 0xD, 0xD2, 0x6B, 0xB5, 0xA, 0xA5, 0xFA, 0xA8, 0xB5, 0x35, 0x6C, 0x98, 0xB2, 0x42, 0xD6, 0xC9, 0xBB, 0xDB, 0x40, 0xF9, 0xBC, 0xAC, 0xE3, 0x6C, 0xD8, 0x32, 0x75, 0x5C, 0xDF, 0x45, 0xCF, 0xD, 0xD6, 0xDC, 0x59, 0x3D, 0xD1, 0xAB, 0xAC, 0x30, 0xD9, 0x26, 0x3A, 0x0, 0xDE, 0x51, 0x80, 0x51, 0xD7, 0xC8, 0x16, 0x61, 0xD0, 0xBF, 0xB5, 0xF4, 0xB4, 0x21, 0x23, 0xC4, 0xB3, 0x56, 0x99, 0x95, 0xBA, 0xCF, 0xF, 0xA5, 0xBD, 0xB8, 0x9E, 0xB8, 0x2, 0x28, 0x8, 0x88, 0x5, 0x5F, 0xB2, 0xD9, 0xC, 0xC6, 0x24, 0xE9, 0xB, 0xB1, 0x87, 0x7C, 0x6F, 0x2F, 0x11, 0x4C, 0x68, 0x58, 0xAB, 0x1D, 0x61, 0xC1, 0x3D, 0x2D, 0x66, 0xB6, 0x90, 0x41, 0xDC, 0x76, 0x6, 0x71, 0xDB, 0x1, 0xBC, 0x20, 0xD2, 0x98, 0x2A, 0x10, 0xD5, 0xEF, 0x89, 0x85, 0xB1, 0x71, 0x1F, 0xB5, 0xB6, 0x6, 0xA5, 0xE4, 0xBF, 0x9F, 0x33, 0xD4, 0xB8, 0xE8, 0xA2, 0xC9, 0x7, 0x78, 0x34, 0xF9, 0x0, 0xF, 0x8E, 0xA8, 0x9, 0x96, 0x18, 0x98, 0xE, 0xE1, 0xBB, 0xD, 0x6A, 0x7F, 0x2D, 0x3D, 0x6D, 0x8, 0x97, 0x6C, 0x64, 0x91, 0x1, 0x5C, 0x63, 0xE6, 0xF4, 0x51, 0x6B, 0x6B, 0x62, 0x61, 0x6C, 0x1C, 0xD8, 0x30, 0x65, 0x85, 0x4E, 0x0, 0x62, 0xF2, 0xED, 0x95, 0x6, 0x6C, 0x7B, 0xA5, 0x1, 0x1B, 0xC1, 0xF4, 0x8, 0x82, 0x57, 0xC4, 0xF, 0xF5, 0xC6, 0xD9, 0xB0, 0x65, 0x50, 0xE9, 0xB7, 0x12, 0xEA, 0xB8, 0xBE, 0x8B, 0x7C, 0x88, 0xB9, 0xFC, 0xDF, 0x1D, 0xDD, 0x62, 0x49, 0x2D, 0xDA, 0x15, 0xF3, 0x7C, 0xD3, 0x8C, 0x65, 0x4C, 0xD4, 0xFB, 0x58, 0x61, 0xB2, 0x4D, 0xCE, 0x51, 0xB5, 0x3A, 0x74, 0x0, 0xBC, 0xA3, 0xE2, 0x30, 0xBB, 0xD4, 0x41, 0xA5, 0xDF, 0x4A, 0xD7, 0x95, 0xD8, 0x3D, 0x6D, 0xC4, 0xD1, 0xA4, 0xFB, 0xF4, 0xD6, 0xD3, 0x6A, 0xE9, 0x69, 0x43, 0xFC, 0xD9, 0x6E, 0x34, 0x46, 0x88, 0x67, 0xAD, 0xD0, 0xB8, 0x60, 0xDA, 0x73, 0x2D, 0x4, 0x44, 0xE5, 0x1D, 0x3, 0x33, 0x5F, 0x4C, 0xA, 0xAA, 0xC9, 0x7C, 0xD, 0xDD, 0x3C, 0x71, 0x5, 0x50, 0xAA, 0x41, 0x2, 0x27, 0x10, 0x10, 0xB, 0xBE, 0x86, 0x20, 0xC, 0xC9, 0x25, 0xB5, 0x68, 0x57, 0xB3, 0x85, 0x6F, 0x20, 0x9, 0xD4, 0x66, 0xB9, 0x9F, 0xE4, 0x61, 0xCE, 0xE, 0xF9, 0xDE, 0x5E, 0x98, 0xC9, 0xD9, 0x29, 0x22, 0x98, 0xD0, 0xB0, 0xB4, 0xA8, 0xD7, 0xC7, 0x17, 0x3D, 0xB3, 0x59, 0x81, 0xD, 0xB4, 0x2E, 0x3B, 0x5C, 0xBD, 0xB7, 0xAD, 0x6C, 0xBA, 0xC0, 0x20, 0x83, 0xB8, 0xED, 0xB6, 0xB3, 0xBF, 0x9A, 0xC, 0xE2, 0xB6, 0x3, 0x9A, 0xD2, 0xB1, 0x74, 0x39, 0x47, 0xD5, 0xEA, 0xAF, 0x77, 0xD2, 0x9D, 0x15, 0x26, 0xDB, 0x4, 0x83, 0x16, 0xDC, 0x73, 0x12, 0xB, 0x63, 0xE3, 0x84, 0x3B, 0x64, 0x94, 0x3E, 0x6A, 0x6D, 0xD, 0xA8, 0x5A, 0x6A, 0x7A, 0xB, 0xCF, 0xE, 0xE4, 0x9D, 0xFF, 0x9, 0x93, 0x27, 0xAE, 0x0, 0xA, 0xB1, 0x9E, 0x7, 0x7D, 0x44, 0x93, 0xF, 0xF0, 0xD2, 0xA3, 0x8, 0x87, 0x68, 0xF2, 0x1, 0x1E, 0xFE, 0xC2, 0x6, 0x69, 0x5D, 0x57, 0x62, 0xF7, 0xCB, 0x67, 0x65, 0x80, 0x71, 0x36, 0x6C, 0x19, 0xE7, 0x6, 0x6B, 0x6E, 0x76, 0x1B, 0xD4, 0xFE, 0xE0, 0x2B, 0xD3, 0x89, 0x5A, 0x7A, 0xDA, 0x10, 0xCC, 0x4A, 0xDD, 0x67, 0x6F, 0xDF, 0xB9, 0xF9, 0xF9, 0xEF, 0xBE, 0x8E, 0x43, 0xBE, 0xB7, 0x17, 0xD5, 0x8E, 0xB0, 0x60, 0xE8, 0xA3, 0xD6, 0xD6, 0x7E, 0x93, 0xD1, 0xA1, 0xC4, 0xC2, 0xD8, 0x38, 0x52, 0xF2, 0xDF, 0x4F, 0xF1, 0x67, 0xBB, 0xD1, 0x67, 0x57, 0xBC, 0xA6, 0xDD, 0x6, 0xB5, 0x3F, 0x4B, 0x36, 0xB2, 0x48, 0xDA, 0x2B, 0xD, 0xD8, 0x4C, 0x1B, 0xA, 0xAF, 0xF6, 0x4A, 0x3, 0x36, 0x60, 0x7A, 0x4, 0x41, 0xC3, 0xEF, 0x60, 0xDF, 0x55, 0xDF, 0x67, 0xA8, 0xEF, 0x8E, 0x6E, 0x31, 0x79, 0xBE, 0x69, 0x46, 0x8C, 0xB3, 0x61, 0xCB, 0x1A, 0x83, 0x66, 0xBC, 0xA0, 0xD2, 0x6F, 0x25, 0x36, 0xE2, 0x68, 0x52, 0x95, 0x77, 0xC, 0xCC, 0x3, 0x47, 0xB, 0xBB, 0xB9, 0x16, 0x2, 0x22, 0x2F, 0x26, 0x5, 0x55, 0xBE, 0x3B, 0xBA, 0xC5, 0x28, 0xB, 0xBD, 0xB2, 0x92, 0x5A, 0xB4, 0x2B, 0x4, 0x6A, 0xB3, 0x5C, 0xA7, 0xFF, 0xD7, 0xC2, 0x31, 0xCF, 0xD0, 0xB5, 0x8B, 0x9E, 0xD9, 0x2C, 0x1D, 0xAE, 0xDE, 0x5B, 0xB0, 0xC2, 0x64, 0x9B, 0x26, 0xF2, 0x63, 0xEC, 0x9C, 0xA3, 0x6A, 0x75, 0xA, 0x93, 0x6D, 0x2, 0xA9, 0x6, 0x9, 0x9C, 0x3F, 0x36, 0xE, 0xEB, 0x85, 0x67, 0x7, 0x72, 0x13, 0x57, 0x0, 0x5, 0x82, 0x4A, 0xBF, 0x95, 0x14, 0x7A, 0xB8, 0xE2, 0xAE, 0x2B, 0xB1, 0x7B, 0x38, 0x1B, 0xB6, 0xC, 0x9B, 0x8E, 0xD2, 0x92, 0xD, 0xBE, 0xD5, 0xE5, 0xB7, 0xEF, 0xDC, 0x7C, 0x21, 0xDF, 0xDB, 0xB, 0xD4, 0xD2, 0xD3, 0x86, 0x42, 0xE2, 0xD4, 0xF1, 0xF8, 0xB3, 0xDD, 0x68, 0x6E, 0x83, 0xDA, 0x1F, 0xCD, 0x16, 0xBE, 0x81, 0x5B, 0x26, 0xB9, 0xF6, 0xE1, 0x77, 0xB0, 0x6F, 0x77, 0x47, 0xB7, 0x18, 0xE6, 0x5A, 0x8, 0x88, 0x70, 0x6A, 0xF, 0xFF, 0xCA, 0x3B, 0x6, 0x66, 0x5C, 0xB, 0x1, 0x11, 0xFF, 0x9E, 0x65, 0x8F, 0x69, 0xAE, 0x62, 0xF8, 0xD3, 0xFF, 0x6B, 0x61, 0x45, 0xCF, 0x6C, 0x16, 0x78, 0xE2, 0xA, 0xA0, 0xEE, 0xD2, 0xD, 0xD7, 0x54, 0x83, 0x4, 0x4E, 0xC2, 0xB3, 0x3, 0x39, 0x61, 0x26, 0x67, 0xA7, 0xF7, 0x16, 0x60, 0xD0, 0x4D, 0x47, 0x69, 0x49, 0xDB, 0x77, 0x6E, 0x3E, 0x4A, 0x6A, 0xD1, 0xAE, 0xDC, 0x5A, 0xD6, 0xD9, 0x66, 0xB, 0xDF, 0x40, 0xF0, 0x3B, 0xD8, 0x37, 0x53, 0xAE, 0xBC, 0xA9, 0xC5, 0x9E, 0xBB, 0xDE, 0x7F, 0xCF, 0xB2, 0x47, 0xE9, 0xFF, 0xB5, 0x30, 0x1C, 0xF2, 0xBD, 0xBD, 0x8A, 0xC2, 0xBA, 0xCA, 0x30, 0x93, 0xB3, 0x53, 0xA6, 0xA3, 0xB4, 0x24, 0x5, 0x36, 0xD0, 0xBA, 0x93, 0x6, 0xD7, 0xCD, 0x29, 0x57, 0xDE, 0x54, 0xBF, 0x67, 0xD9, 0x23, 0x2E, 0x7A, 0x66, 0xB3, 0xB8, 0x4A, 0x61, 0xC4, 0x2, 0x1B, 0x68, 0x5D, 0x94, 0x2B, 0x6F, 0x2A, 0x37, 0xBE, 0xB, 0xB4, 0xA1, 0x8E, 0xC, 0xC3, 0x1B, 0xDF, 0x5, 0x5A, 0x8D, 0xEF, 0x02, 0x2D]
-        r = 0
-        for i in range(len(message)):
-            val = message[i]
-            val = val ^ r
-            val = val & 0xFF
-            offset = val << 2
-            val = table[offset + 3] << 24 | table[offset + 2] << 16 | table[offset + 1] << 8 | table[offset]
-            r = val ^ (r >> 8)
-        return r
+        # Standard reflected CRC-32 table algorithm, but with an initial value
+        # of 0 and no final xor. zlib applies ~ to the passed value before and
+        # to the result after the calculation, so both get cancelled out here.
+        return zlib.crc32(message, 0xFFFFFFFF) ^ 0xFFFFFFFF
 
     @staticmethod
     def de_or_encrypt_udp_message(message, tid):
-        key = [
-            0x1f2d3c4b, 0x5a6c7f8d, 
-            0x38172e4b, 0x8271635a,
-            0x863f1a2b, 0xa5c6f7d8, 
-            0x8371e1b4, 0x17f2d3a5
-        ]
-        result = b''
-        
-        for i in range(0, 8):
-            key[i] = key[i] + tid
-
-        i = len(message) + 3
-        if i < 0:
-            i = len(message) + 6
-
-        for x in range(0, i//4):
-            index = x & 7
-            xor_key_word = key[index]
-
-            for b in range(0, 4):
-                byte_index = x * 4 + b
-                val = message[byte_index]
-                key_byte = (xor_key_word >> (b * 8)) & 0xFF
-                val = key_byte ^ val
-                result += bytes([val & 0xFF])
-                if byte_index >= len(message) - 1:
-                    return result
-        return result
-
-    def recv_packet(self):
-        message = None
-        packet_id = None
-        while True:
-            data, sender = self.socket.recvfrom(4096)
-            (udp_message_id, client_id, unknown, packet_id, size) = struct.unpack_from("<iIIiI", data)
-            if client_id != self.client_id:
-                    continue
-            udp_header_len = 20
-            message = data[udp_header_len:udp_header_len+size]
-            if udp_message_id == UDP_MESSAGE_ID_CTRL:
-                if packet_id == self.last_received_packet_id + 1:
-                    self.last_received_packet_id = packet_id
-                    self.send_acknowledgement()
-                else:
-                    continue
+        length = len(message)
+        if length == 0:
+            return b''
+        # Each key word is offset by the tid and applied as 4 little endian bytes
+        key = b''.join(((key_word + tid) & 0xFFFFFFFF).to_bytes(4, 'little') for key_word in UDP_KEY)
+        keystream = (key * (length // len(key) + 1))[:length]
+        return (int.from_bytes(message, 'little') ^ int.from_bytes(keystream, 'little')).to_bytes(length, 'little')
+
+    def _next_timer_deadline(self):
+        deadlines = [unack_message["send_time"] + self._retransmission_timeout(unack_message) for unack_message in self.unack_messages.values()]
+        if self.ack_deadline != None:
+            deadlines.append(self.ack_deadline)
+        return min(deadlines) if len(deadlines) > 0 else None
+
+    def _handle_timers(self):
+        if self.ack_deadline != None and time.monotonic() >= self.ack_deadline:
+            self.send_acknowledgement()
+        self._retransmit_expired_packets()
+
+    def _schedule_timer(self):
+        # A single loop timer serves the delayed acknowledgement and all retransmission timers.
+        # An existing timer which fires too early is kept, it just reschedules itself.
+        deadline = self._next_timer_deadline()
+        if deadline == None:
+            return
+        if self.timer_handle != None:
+            if self.timer_deadline <= deadline:
+                return
+            self.timer_handle.cancel()
+        self.timer_deadline = deadline
+        self.timer_handle = self.loop.call_later(max(0, deadline - time.monotonic()), self._on_timer)
+
+    def _on_timer(self):
+        self.timer_handle = None
+        self._handle_timers()
+        self._schedule_timer()
+
+    def _read_ready(self):
+        # Drain the datagrams which are already waiting, but at most RECV_BATCH_SIZE
+        # at once so that the other cameras on the loop are not starved.
+        # Each datagram is handled completely before the buffer is reused.
+        for _ in range(RECV_BATCH_SIZE):
+            try:
+                size, sender = self.socket.recvfrom_into(self.recv_buffer)
+            except (BlockingIOError, InterruptedError):
                 break
-            elif udp_message_id == UDP_MESSAGE_ID_ACK:
-                self.handle_acknowledgement(data)
-            elif udp_message_id == UDP_MESSAGE_ID_DISCOVERY:
-                logger.info("Received discovery message from camera")
-        return message
+            except OSError as ex:
+                self.error_received(ex)
+                break
+            self.datagram_received(memoryview(self.recv_buffer)[:size], sender)
+        self._schedule_timer()
+
+    def error_received(self, exc):
+        logger.debug("Socket error: %s", exc)
+
+    def datagram_received(self, data, sender):
+        if len(data) < UDP_HEADER_LENGTH:
+            return
+        (udp_message_id, client_id, unknown, packet_id, size) = struct.unpack_from("<iIIiI", data)
+        if udp_message_id == UDP_MESSAGE_ID_DISCOVERY:
+            self._handle_discovery_message(data, sender)
+            return
+        if client_id != self.client_id:
+            return
+        if udp_message_id == UDP_MESSAGE_ID_CTRL:
+            self._handle_ctrl_packet(packet_id, data[UDP_HEADER_LENGTH:UDP_HEADER_LENGTH+size])
+        elif udp_message_id == UDP_MESSAGE_ID_ACK:
+            self.handle_acknowledgement(data)
+
+    def _handle_discovery_message(self, data, sender):
+        (udp_message_id, size, unknown, tid, checksum) = struct.unpack_from("<iIIiI", data)
+        message = data[UDP_HEADER_LENGTH:UDP_HEADER_LENGTH+size]
+        actual_checksum = self.calc_crc(message)
+        if checksum != actual_checksum:
+            logger.warn("Invalid checksum - expected: %d actual: %d", checksum, actual_checksum)
+            return
+        try:
+            xml_root = ElementTree.fromstring(self.de_or_encrypt_udp_message(message, tid).decode("utf-8"))
+        except (UnicodeDecodeError, ElementTree.ParseError):
+            logger.warn("Received invalid discovery message from %s", sender[0])
+            return
+        logger.info("Received discovery message from %s", sender[0])
+        discovery_messages = self.local_discovery_messages if xml_root.find("D2C_C_R") != None else self.p2p_discovery_messages
+        try:
+            discovery_messages.put_nowait((xml_root, sender))
+        except asyncio.QueueFull:
+            logger.debug("Discovery message queue is full, dropping message")
+
+    def _deliver_packet(self, message):
+        if self.packet_handler != None:
+            self.packet_handler(message)
+
+    def _release_reordered_packets(self):
+        # Deliver all early arrivals which directly follow the last in order packet
+        gap_fill_time = None
+        while self.last_received_packet_id + 1 in self.reordered_packets:
+            (message, arrival_time) = self.reordered_packets.pop(self.last_received_packet_id + 1)
+            gap_fill_time = arrival_time if gap_fill_time == None else min(gap_fill_time, arrival_time)
+            self.last_received_packet_id += 1
+            self.unacknowledged_packet_count += 1
+            self._deliver_packet(message)
+        if gap_fill_time != None:
+            gap_fill_latency = time.monotonic() - gap_fill_time
+            self.reorder_stats["gaps_filled"] += 1
+            self.reorder_stats["last_gap_fill_latency"] = gap_fill_latency
+            self.reorder_stats["max_gap_fill_latency"] = max(self.reorder_stats["max_gap_fill_latency"], gap_fill_latency)
+            logger.debug("Filled packet gap after %.4fs", gap_fill_latency)
+        return gap_fill_time != None
+
+    def _schedule_acknowledgement(self):
+        if self.unacknowledged_packet_count >= self.ack_every_packets:
+            self.send_acknowledgement()
+        elif self.ack_deadline == None:
+            self.ack_deadline = time.monotonic() + self.ack_delay
+
+    def _handle_ctrl_packet(self, packet_id, message):
+        if packet_id == self.last_received_packet_id + 1:
+            self.last_received_packet_id = packet_id
+            self.unacknowledged_packet_count += 1
+            self._deliver_packet(message)
+            if self._release_reordered_packets():
+                self.send_acknowledgement()
+            else:
+                self._schedule_acknowledgement()
+        elif self.last_received_packet_id + 1 < packet_id <= self.last_received_packet_id + REORDER_WINDOW_SIZE:
+            # Hold early arrivals until the gap before them is filled. They have to be
+            # copied, because the receive buffer they point into is going to be reused.
+            if packet_id not in self.reordered_packets:
+                self.reordered_packets[packet_id] = (bytes(message), time.monotonic())
+                self.reorder_stats["reordered_packets"] += 1
+                self.reorder_stats["max_depth"] = max(self.reorder_stats["max_depth"], len(self.reordered_packets))
+            # Acknowledge gaps immediately, so the camera notices the missing packet
+            self.send_acknowledgement()
+        else:
+            self.send_acknowledgement()
 
     def send_packet(self, baichuan_packet):
-        MAX_SIZE = 1330
-        baichuan_packets = []
-        num_packets = math.ceil(len(baichuan_packet) / MAX_SIZE)
-        for _ in range(num_packets):
-            baichuan_packets.append(baichuan_packet[0:1330])
-            baichuan_packet = baichuan_packet[1330:]
-
-        for packet in baichuan_packets:
-            raw_packet = b''
-            raw_packet += UDP_MESSAGE_ID_CTRL.to_bytes(4, 'little')
-            raw_packet += self.device_id.to_bytes(4, 'little')
-            raw_packet += bytes([0x00, 0x00, 0x00, 0x00])
-            raw_packet += self.last_send_packet_id.to_bytes(4, 'little')
-            raw_packet += len(packet).to_bytes(4, 'little')
-            raw_packet += packet
-
-            self.unack_messages[self.last_send_packet_id] = raw_packet
-            
-            self.socket.sendto(raw_packet, self.target_address)
+        for offset in range(0, len(baichuan_packet), CTRL_MAX_PAYLOAD_SIZE):
+            packet = baichuan_packet[offset:offset+CTRL_MAX_PAYLOAD_SIZE]
+            raw_packet = CTRL_HEADER_STRUCT.pack(UDP_MESSAGE_ID_CTRL, self.device_id, 0, self.last_send_packet_id, len(packet)) + packet
+            self.send_queue.append((self.last_send_packet_id, raw_packet))
             self.last_send_packet_id += 1
+        self._send_queued_packets()
+        self._schedule_timer()
+
+    def _send_queued_packets(self):
+        while len(self.send_queue) > 0 and len(self.unack_messages) < SEND_WINDOW_SIZE:
+            (packet_id, raw_packet) = self.send_queue.popleft()
+            self.unack_messages[packet_id] = {
+                "raw_packet": raw_packet,
+                "send_time": time.monotonic(),
+                "retransmissions": 0,
+            }
+            self.socket.sendto(raw_packet, self.target_address)
+
+    def _retransmit(self, packet_id):
+        unack_message = self.unack_messages[packet_id]
+        unack_message["send_time"] = time.monotonic()
+        unack_message["retransmissions"] += 1
+        self.retransmission_count += 1
+        logger.debug("Retransmitting packet %d (retransmission %d)", packet_id, unack_message["retransmissions"])
+        self.socket.sendto(unack_message["raw_packet"], self.target_address)
+
+    def _retransmission_timeout(self, unack_message):
+        # Exponential backoff for packets which were already retransmitted
+        return min(MAX_RTO, self.rto * (2 ** unack_message["retransmissions"]))
+
+    def _retransmit_expired_packets(self):
+        now = time.monotonic()
+        for packet_id, unack_message in self.unack_messages.items():
+            if now >= unack_message["send_time"] + self._retransmission_timeout(unack_message):
+                self._retransmit(packet_id)
+
+    def _update_rto(self, rtt):
+        # RFC 6298
+        if self.smoothed_rtt == None:
+            self.smoothed_rtt = rtt
+            self.rtt_variation = rtt / 2
+        else:
+            self.rtt_variation = 0.75 * self.rtt_variation + 0.25 * abs(self.smoothed_rtt - rtt)
+            self.smoothed_rtt = 0.875 * self.smoothed_rtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.smoothed_rtt + 4 * self.rtt_variation))
+
+    def _acknowledge_sent_packet(self, packet_id, now):
+        unack_message = self.unack_messages.pop(packet_id)
+        # Karn's algorithm: round trip times of retransmitted packets are ambiguous
+        if unack_message["retransmissions"] == 0:
+            return now - unack_message["send_time"]
+        return None
 
     def handle_acknowledgement(self, data):
-        (udp_message_id, client_id, _, _, packet_id, _, _) = struct.unpack_from("<iIiiIii", data)
+        (udp_message_id, client_id, _, _, packet_id, _, payload_len) = ACK_HEADER_STRUCT.unpack_from(data)
         if udp_message_id != UDP_MESSAGE_ID_ACK or client_id != self.client_id:
             return
-        if packet_id < self.last_send_packet_id - 1:
-            self.wait_acknowledgement += 1
-            # Give the camera some time to send
-            # the correct acknowledged packet id
-            if self.wait_acknowledgement > 10:
-                self.resend_unacknowledged_packets(packet_id, self.last_send_packet_id - 1)
-        elif self.wait_acknowledgement != 0:
-            self.unack_messages = {}
-            self.wait_acknowledgement = 0
-        
-    def resend_unacknowledged_packets(self, packet_id, max_message):
-        for i in range(packet_id + 1, max_message + 1):
-            raw_packet = self.unack_messages[i]
-            self.socket.sendto(raw_packet, self.target_address)
-    
+        now = time.monotonic()
+        rtt = None
+
+        # The acknowledged packet id is cumulative
+        for acknowledged_packet_id in [unack_packet_id for unack_packet_id in self.unack_messages if unack_packet_id <= packet_id]:
+            rtt = self._acknowledge_sent_packet(acknowledged_packet_id, now) or rtt
+
+        # The payload contains one flag per packet following the acknowledged packet id,
+        # flags which are not set before the last set flag mark missing packets
+        flags = bytes(data[ACK_HEADER_STRUCT.size:ACK_HEADER_STRUCT.size+payload_len])
+        missing_packet_ids = []
+        for index, received in enumerate(flags):
+            flag_packet_id = packet_id + 1 + index
+            if flag_packet_id not in self.unack_messages:
+                continue
+            if received:
+                rtt = self._acknowledge_sent_packet(flag_packet_id, now) or rtt
+                self.duplicate_ack_count = 0
+            else:
+                missing_packet_ids.append(flag_packet_id)
+        missing_packet_ids = [missing_packet_id for missing_packet_id in missing_packet_ids if missing_packet_id < packet_id + 1 + len(flags.rstrip(b'\0'))]
+
+        if rtt != None:
+            self._update_rto(rtt)
+
+        if packet_id == self.last_acknowledged_packet_id and packet_id + 1 in self.unack_messages:
+            self.duplicate_ack_count += 1
+            if self.duplicate_ack_count == FAST_RETRANSMIT_DUPLICATE_ACKS and packet_id + 1 not in missing_packet_ids:
+                missing_packet_ids.insert(0, packet_id + 1)
+        else:
+            self.last_acknowledged_packet_id = packet_id
+            self.duplicate_ack_count = 0
+
+        # Selectively retransmit only the missing packets,
+        # at most once per round trip time
+        for missing_packet_id in missing_packet_ids:
+            if now - self.unack_messages[missing_packet_id]["send_time"] >= (self.smoothed_rtt or self.rto):
+                self._retransmit(missing_packet_id)
+
+        self._send_queued_packets()
+
     def send_acknowledgement(self):
-        packet = b''
-        packet += UDP_MESSAGE_ID_ACK.to_bytes(4, 'little')
-        packet += self.device_id.to_bytes(4, 'little')
-        x = 0
-        packet += x.to_bytes(4, 'little')
-        packet += x.to_bytes(4, 'little')
-        packet += self.last_received_packet_id.to_bytes(4, 'little')
-        packet += x.to_bytes(4, 'little')
-        packet += x.to_bytes(4, 'little')
+        packet = ACK_STRUCT.pack(UDP_MESSAGE_ID_ACK, self.device_id, 0, 0, self.last_received_packet_id, 0, 0)
+        self.unacknowledged_packet_count = 0
+        self.ack_deadline = None
 
         self.socket.sendto(packet, self.target_address)
 
@@ -339,7 +576,7 @@ class BaichuanUdpLayer:
         discovery_message += checksum.to_bytes(4, 'little')
         discovery_message += enc_xml_bytes
 
-        self.socket.sendto(discovery_message, (host, 9999))
+        self.socket.sendto(discovery_message, (host, P2P_RELAY_PORT))
 
     def _send_p2p_register(self, register_address, relay_address):
         xml_body = f"<P2P>\n<C2R_C>\n<uid>{self.device_sid}</uid>\n<cli>\n<ip>{BINDING_IFACE_IP}</ip>\n<port>{self.communication_port}</port>\n</cli>\n<relay>\n<ip>{relay_address[0]}</ip>\n<port>{relay_address[1]}</port>\n</relay>\n<cid>{self.client_id}</cid>\n<debug>{0}</debug>\n<family>4</family>\n<p>{CLIENT_OS}</p>\n</C2R_C>\n</P2P>\n"
@@ -416,6 +653,19 @@ class BaichuanUdpLayer:
         server_address = (BINDING_IFACE_IP, self.discovery_src_port)
         sock.bind(server_address)
 
+        remote_address = ("255.255.255.255", DEVICE_DISCOVERY_PORT)
+        sock.sendto(self._create_discovery_message(), remote_address)
+        sock.close()
+        
+        if self.discovery_src_port >= DISCOVERY_PORT_END:
+            self.discovery_src_port = DISCOVERY_PORT_START - 1
+
+        self.discovery_src_port += 1
+
+    def _send_discovery_unicast(self, host):
+        self.socket.sendto(self._create_discovery_message(), (host, DEVICE_DISCOVERY_PORT))
+
+    def _create_discovery_message(self):
         xml_body = f"<P2P>\n<C2D_C>\n<uid>{self.device_sid}</uid>\n<cli>\n<port>{self.communication_port}</port>\n</cli>\n<cid>{self.client_id}</cid>\n<mtu>{ETHERNET_MTU}</mtu>\n<debug>{0}</debug>\n<p>{CLIENT_OS}</p>\n</C2D_C>\n</P2P>\n"
         xml_bytes = xml_body.encode("utf-8")
 
@@ -429,11 +679,4 @@ class BaichuanUdpLayer:
         discovery_message += self.tid.to_bytes(4, 'little')
         discovery_message += checksum.to_bytes(4, 'little')
         discovery_message += enc_xml_bytes
-        
-        remote_address = ("255.255.255.255", 2015)
-        sock.sendto(discovery_message, remote_address)
-        
-        if self.discovery_src_port >= DISCOVERY_PORT_END:
-            self.discovery_src_port = DISCOVERY_PORT_START - 1
-
-        self.discovery_src_port += 1
\ No newline at end of file
+        return discovery_message
\ No newline at end of file
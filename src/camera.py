@@ -1,5 +1,6 @@
+import time
 import random
-import socket
+import asyncio
 import struct
 import logging
 import xml.etree.ElementTree as ElementTree
@@ -8,31 +9,53 @@ import baichuan_control_layer
 from datetime import datetime
 
 MAX_INT32 = 0x7FFFFFFF
+# While parked, the session is kept alive with pings and
+# reconnected if the camera didn't answer for PARKED_SESSION_TIMEOUT seconds
+PARKED_PING_INTERVAL = 5
+PARKED_SESSION_TIMEOUT = 30
 
 logger = logging.getLogger(__name__)
 
 class Camera:
-    def __init__(self, device_sid, username, password):
+    def __init__(self, device_sid, username, password, ack_every_packets=baichuan_udp_layer.ACK_EVERY_PACKETS, ack_delay_ms=baichuan_udp_layer.ACK_DELAY_MS, parked=False, video_stream=baichuan_control_layer.MAINSTREAM):
         self.device_sid = device_sid
         self.username = username
         self.password = password
+        self.ack_every_packets = ack_every_packets
+        self.ack_delay_ms = ack_delay_ms
         self.is_running = False
+        # A parked camera keeps its authenticated session, but doesn't stream video
+        self.parked = parked
+        # Main or sub stream, it is switched on the running session. Every switch starts
+        # a new generation, the data is passed on with the generation of the running stream.
+        self.video_stream = video_stream
+        self.video_stream_generation = 0
+        self.loop = None
+        self.resume_event = None
 
-    def start(self, handle_video_and_audio_stream):
+    async def start(self, handle_video_and_audio_stream):
+        self.loop = asyncio.get_running_loop()
+        self.resume_event = asyncio.Event()
         self.is_running = True
         while self.is_running:
             try:
-                self._start_stream(handle_video_and_audio_stream)
+                await self._start_stream(handle_video_and_audio_stream)
             except Exception as e:
                 logger.error("Exception occured: %s Trying to reconnect the camera stream...", e)
     
-    def _start_stream(self, handle_video_and_audio_stream):
+    async def _start_stream(self, handle_video_and_audio_stream):
         client_id = random.randint(0, MAX_INT32)
 
-        udp_layer = baichuan_udp_layer.BaichuanUdpLayer(self.device_sid, client_id)
-        control_layer = baichuan_control_layer.BaichuanControlLayer(self.username, self.password, udp_layer)
+        udp_layer = baichuan_udp_layer.BaichuanUdpLayer(self.device_sid, client_id, ack_every_packets=self.ack_every_packets, ack_delay_ms=self.ack_delay_ms)
+        try:
+            await udp_layer.open()
+            control_layer = baichuan_control_layer.BaichuanControlLayer(self.username, self.password, udp_layer)
+            await self._stream(udp_layer, control_layer, handle_video_and_audio_stream)
+        finally:
+            udp_layer.close()
 
-        udp_layer.discover_device()
+    async def _stream(self, udp_layer, control_layer, handle_video_and_audio_stream):
+        await udp_layer.discover_device()
 
         logger.info("Sending legacy login packet")
         # send legacy login
@@ -42,7 +65,7 @@ class Camera:
         logger.info("Receiving nonce packet")
         nonce = None
         while nonce == None:
-            (modern_message_id, _, message, _) = control_layer.recv_packet()
+            (modern_message_id, _, message, _) = await control_layer.recv_packet()
             if modern_message_id != baichuan_control_layer.BAICHUAN_MESSAGE_ID_LOGIN:
                 continue
             xml_root = ElementTree.fromstring(message)
@@ -55,22 +78,40 @@ class Camera:
         logger.info("Sending modern login packet")
         control_layer.send_modern_login_packet(nonce)
         while True:
-            (modern_message_id, _, message, binary_data) = control_layer.recv_packet()
+            (modern_message_id, _, message, binary_data) = await control_layer.recv_packet()
             if modern_message_id == baichuan_control_layer.BAICHUAN_MESSAGE_ID_VIDEO_INPUT:
                 break
         
-        logger.info("Send start video cmd")
-        control_layer.start_video(baichuan_control_layer.MAINSTREAM)
         video_stream = b''
         audio_stream = b''
 
         i = 0
-        udp_layer.socket.settimeout(5) #Wifi camera can take a while to recover the network
+        udp_layer.timeout = 5 #Wifi camera can take a while to recover the network
         retry = 3
+        running_video_stream = None
+        running_generation = None
         while self.is_running:
+            if self.parked:
+                if running_video_stream != None:
+                    logger.info("Parking camera session, send stop video cmd")
+                    control_layer.stop_video(running_video_stream)
+                    running_video_stream = None
+                await self._park(control_layer)
+                continue
+            if running_video_stream is None or running_generation != self.video_stream_generation:
+                if running_video_stream != None:
+                    logger.info("Switching from %s to %s, send stop video cmd", running_video_stream, self.video_stream)
+                    control_layer.stop_video(running_video_stream)
+                logger.info("Send start video cmd (%s)", self.video_stream)
+                running_video_stream = self.video_stream
+                running_generation = self.video_stream_generation
+                control_layer.start_video(running_video_stream)
             try:
-                (modern_message_id, _, message, binary_data) = control_layer.recv_packet()
+                (modern_message_id, _, message, binary_data) = await control_layer.recv_packet()
                 retry = 3
+                key_frame = False
+                # UTC time of the camera, only sent with I-frames
+                utc_time = None
                 I_FRAME = 0x63643030
                 P_FRAME = 0x63643130
                 VIDEO_INFO_V1 = 0x31303031
@@ -94,7 +135,8 @@ class Camera:
                         # 4 bytes unknown
                         (magic, video_type, data_size, _, _, _, utc_time, _) = struct.unpack_from("<iIIIIIII", video_data)
                         timestamp = datetime.utcfromtimestamp(utc_time).strftime('%Y-%m-%d %H:%M:%S')
-                        logger.debug("I Frame found")
+                        logger.debug("I Frame found (%s)", timestamp)
+                        key_frame = True
                         video_stream_data = video_data[I_FRAME_HEADER_SIZE:I_FRAME_HEADER_SIZE+data_size]
                         if video_type == VIDEO_TYPE_H264:
                             video_stream += video_stream_data
@@ -131,21 +173,59 @@ class Camera:
                 else:
                     logger.debug("Received unknown message. modern_message_id: %d", modern_message_id)
 
-                handle_video_and_audio_stream(video_stream, audio_stream)
+                handle_video_and_audio_stream(video_stream, audio_stream, key_frame, utc_time, running_generation)
                 video_stream = b''
                 audio_stream = b''
 
                 if i % 16 == 0:
                     logger.debug("Sending ping")
+                    logger.debug("Reorder stats: %s", udp_layer.reorder_stats)
                     control_layer.ping()
                     i=0
                 i += 1
-            except socket.timeout as ex:
+            except asyncio.TimeoutError as ex:
                 if retry <= 0:
                     raise ex
                 retry-=1
-                control_layer.start_video(baichuan_control_layer.MAINSTREAM)
+                control_layer.start_video(running_video_stream)
                 continue
 
+    async def _park(self, control_layer):
+        self.resume_event.clear()
+        last_message_time = time.monotonic()
+        while self.is_running and self.parked:
+            control_layer.ping()
+            try:
+                await asyncio.wait_for(self.resume_event.wait(), PARKED_PING_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            # Only pongs, status messages and the rest of the stopped video arrive while parked
+            while True:
+                try:
+                    (modern_message_id, _, _, _) = control_layer.recv_packet_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                last_message_time = time.monotonic()
+                logger.debug("Received message while parked. modern_message_id: %d", modern_message_id)
+            if time.monotonic() - last_message_time > PARKED_SESSION_TIMEOUT:
+                raise Exception("Parked camera session doesn't answer pings")
+
+    def park(self):
+        self.parked = True
+
+    def resume(self):
+        '''Return the generation of the resumed video, like after a switch of the video stream.'''
+        self.video_stream_generation += 1
+        self.parked = False
+        if self.loop != None:
+            self.loop.call_soon_threadsafe(self.resume_event.set)
+        return self.video_stream_generation
+
+    def switch_video_stream(self, video_stream):
+        '''Return the generation of the new stream, the camera starts it with an I-frame.'''
+        self.video_stream = video_stream
+        self.video_stream_generation += 1
+        return self.video_stream_generation
+
     def stop(self):
         self.is_running = False
\ No newline at end of file
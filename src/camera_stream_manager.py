@@ -1,15 +1,50 @@
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 from threading import Thread, RLock
 from datetime import datetime
 from camera import Camera
+from baichuan_control_layer import MAINSTREAM, SUBSTREAM
+from baichuan_udp_layer import ACK_EVERY_PACKETS, ACK_DELAY_MS
 from decoder import Decoder
+from process_decoder import ProcessDecoder
+from mjpeg_encoder import MjpegEncoder
+from lazy_frame import RENDITIONS
+from video_passthrough import VideoPassthrough
+from recorder import Recorder, RECORD_SEGMENT_SECONDS
+from gop_buffer import GOP_BUFFER_SIZE
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_TIMEOUT = 10
+IDLE_TIMEOUT = 30
+PARK_TIMEOUT = 0
+# idle: the stream is parked after idleTimeout seconds and stopped parkTimeout seconds later
+# always: the session is started with the proxy and never stopped, only parked
+# schedule: like always during the warmWindows, like idle outside of them
+KEEP_ALIVE_POLICIES = ["idle", "always", "schedule"]
+# main: always the main stream, sub: always the sub stream
+# auto: the sub stream, unless a consumer needs more than the SUBSTREAM_SIZES
+VIDEO_STREAM_POLICIES = ["main", "sub", "auto"]
+SUBSTREAM_SIZES = ["thumb"]
 
 class CameraStreamManager:
-    def __init__(self, camera_settings):
+    def __init__(self, camera_settings, decoder_threads=None):
         self.camera_settings = camera_settings
         self.streams = []
         self.stream_lock = RLock()
+        # All camera sessions share one event loop thread and
+        # all decoders share one bounded pool of decoder threads.
+        # The UDP layer registers its socket with add_reader, which the
+        # default proactor loop on Windows doesn't support.
+        self.loop = asyncio.SelectorEventLoop()
+        self.loop_thread = Thread(target=self.loop.run_forever, name="CameraEventLoop", daemon=True)
+        self.loop_thread.start()
+        self.decoder_executor = ThreadPoolExecutor(max_workers=decoder_threads, thread_name_prefix="DecoderThread")
     
-    def start_decoding_camera_stream(self, camera_name):
+    def start_decoding_camera_stream(self, camera_name, parked=False, video_stream=MAINSTREAM):
         camera_settings = self.get_camera_settings_by_name(camera_name)
         if camera_settings is None:
             return None
@@ -22,26 +57,57 @@ class CameraStreamManager:
         username = camera_settings["username"]
         password = camera_settings["password"]
         backup_image = camera_settings["backupImage"] if "backupImage" in camera_settings else None
+        snapshot_timeout = camera_settings["snapshotTimeout"] if "snapshotTimeout" in camera_settings else SNAPSHOT_TIMEOUT
+        decode_on_demand = camera_settings["decodeOnDemand"] if "decodeOnDemand" in camera_settings else False
+        decode_in_process = camera_settings["decodeInProcess"] if "decodeInProcess" in camera_settings else False
+        codec_threads = camera_settings["codecThreads"] if "codecThreads" in camera_settings else None
+        codec_thread_type = camera_settings["codecThreadType"] if "codecThreadType" in camera_settings else None
+        target_fps = camera_settings["targetFps"] if "targetFps" in camera_settings else None
+        ack_every_packets = camera_settings["ackEveryPackets"] if "ackEveryPackets" in camera_settings else ACK_EVERY_PACKETS
+        ack_delay_ms = camera_settings["ackDelayMs"] if "ackDelayMs" in camera_settings else ACK_DELAY_MS
+        gop_buffer_size = camera_settings["gopBufferMb"] * 1024 * 1024 if "gopBufferMb" in camera_settings else GOP_BUFFER_SIZE
+        record_path = camera_settings["recordPath"] if "recordPath" in camera_settings else None
+        record_segment_seconds = camera_settings["recordSegmentSeconds"] if "recordSegmentSeconds" in camera_settings else RECORD_SEGMENT_SECONDS
+        record_retention_hours = camera_settings["recordRetentionHours"] if "recordRetentionHours" in camera_settings else None
+        record_max_size_mb = camera_settings["recordMaxSizeMb"] if "recordMaxSizeMb" in camera_settings else None
         
-        camera = Camera(device_sid, username, password)
-        decoder = Decoder()
-        def start_camera():
-            camera.start(lambda video_data, audio_data: decoder.queue_data(video_data))
-        
-        camera_thread = Thread(target=start_camera, name="CameraThread", daemon=True)
-        camera_thread.start()
-
-        decoder_thread = Thread(target=decoder.process, name="DecoderThread", daemon=True)
-        decoder_thread.start()
+        camera = Camera(device_sid, username, password, ack_every_packets, ack_delay_ms, parked, video_stream)
+        if decode_in_process:
+            decoder = ProcessDecoder(decode_on_demand, codec_threads, codec_thread_type, target_fps, gop_buffer_size)
+        else:
+            decoder = Decoder(self.decoder_executor, decode_on_demand, codec_threads, codec_thread_type, target_fps, gop_buffer_size)
+        video_passthrough = VideoPassthrough(gop_buffer_size=gop_buffer_size)
+        recorder = None
+        if record_path != None:
+            recorder = Recorder(os.path.join(record_path, camera_name), record_segment_seconds,
+                record_retention_hours * 3600 if record_retention_hours != None else None,
+                record_max_size_mb * 1024 * 1024 if record_max_size_mb != None else None)
+        def handle_video_and_audio_stream(video_data, audio_data, key_frame, utc_time, generation):
+            decoder.queue_data(video_data, key_frame, generation)
+            video_passthrough.queue_data(video_data)
+            if recorder != None:
+                recorder.queue_data(video_data, audio_data, key_frame, utc_time)
+        camera_future = asyncio.run_coroutine_threadsafe(camera.start(handle_video_and_audio_stream), self.loop)
 
         stream = {}
         stream["name"] = camera_name
         stream["camera"] = camera
-        stream["camera_thread"] = camera_thread
-        stream["decoder_thread"] = decoder_thread
+        stream["camera_future"] = camera_future
         stream["decoder"] = decoder
+        stream["mjpeg_encoders"] = {size: MjpegEncoder(decoder, size) for size in RENDITIONS}
+        stream["video_passthrough"] = video_passthrough
+        stream["recorder"] = recorder
         stream["last_accessed"] = datetime.now()
+        stream["video_stream"] = video_stream
+        # When each video stream was last needed by a consumer
+        stream["video_stream_accessed"] = {MAINSTREAM: datetime.min, SUBSTREAM: datetime.min}
+        stream["video_stream_accessed"][video_stream] = stream["last_accessed"]
+        stream["start_time"] = time.time_ns()
         stream["backup_image"] = backup_image
+        stream["snapshot_timeout"] = snapshot_timeout
+        stream["parked"] = parked
+        # Generation of the current video stream, consumers wait for its frames after a switch or a resume
+        stream["video_stream_generation"] = camera.video_stream_generation
         with self.stream_lock:
             self.streams.append(stream)
         return stream
@@ -54,22 +120,137 @@ class CameraStreamManager:
         with self.stream_lock:
             self.streams.remove(stream)
         camera = stream["camera"]
-        camera_thread = stream["camera_thread"]
         camera.stop()
         decoder = stream["decoder"]
         decoder.stop()
-        decoder_thread = stream["decoder_thread"]
-        camera_thread.join()
-        decoder_thread.join()
+        stream["video_passthrough"].close()
+        recorder = stream["recorder"]
+        if recorder != None:
+            recorder.stop()
+        camera_future = stream["camera_future"]
+        camera_future.cancel()
+        try:
+            camera_future.result()
+        except CancelledError:
+            pass
+        except Exception:
+            logger.warning("Camera stream %s stopped with an exception", camera_name, exc_info=True)
         return True
     
+    def park_camera_stream(self, camera_name):
+        stream = self.get_stream_by_name(camera_name)
+        if stream is None or stream["parked"]:
+            return False
+        stream["parked"] = True
+        stream["camera"].park()
+        return True
+
+    def resume_camera_stream(self, camera_name):
+        stream = self.get_stream_by_name(camera_name)
+        if stream is not None and stream["parked"]:
+            stream["parked"] = False
+            # The frames from before the stream was parked, even those still buffered in the decoder, are of an older generation
+            stream["video_stream_generation"] = stream["camera"].resume()
+        return stream
+
+    def get_video_stream(self, camera_name, stream_policy=None, size="full"):
+        '''Return the video stream (MAINSTREAM or SUBSTREAM) a consumer of the rendition 'size' needs.
+        Without a 'stream_policy' the stream setting of the camera applies.
+        '''
+        if stream_policy is None:
+            camera_settings = self.get_camera_settings_by_name(camera_name)
+            stream_policy = camera_settings["stream"] if camera_settings != None and "stream" in camera_settings else "main"
+        if stream_policy == "auto":
+            return SUBSTREAM if size in SUBSTREAM_SIZES else MAINSTREAM
+        return SUBSTREAM if stream_policy == "sub" else MAINSTREAM
+
+    def request_video_stream(self, camera_name, video_stream):
+        '''Switches to the main stream right away if it is requested. The camera only switches
+        back to the sub stream once the main stream wasn't requested for idleTimeout seconds.
+        '''
+        self.update_last_accessed_timestamp(camera_name, video_stream)
+        stream = self.get_stream_by_name(camera_name)
+        if stream is not None:
+            self._select_video_stream(stream, self._get_idle_timeout(self.get_camera_settings_by_name(camera_name)))
+
+    def _select_video_stream(self, stream, idle_timeout):
+        now = datetime.now()
+        video_stream_accessed = stream["video_stream_accessed"]
+        if (now - video_stream_accessed[MAINSTREAM]).total_seconds() <= idle_timeout:
+            video_stream = MAINSTREAM
+        elif (now - video_stream_accessed[SUBSTREAM]).total_seconds() <= idle_timeout:
+            video_stream = SUBSTREAM
+        else:
+            # Nobody watches, the stream is parked or stopped soon
+            return
+        if video_stream == stream["video_stream"]:
+            return
+        logger.info("Switching camera stream %s to %s", stream["name"], video_stream)
+        stream["video_stream"] = video_stream
+        stream["video_stream_generation"] = stream["camera"].switch_video_stream(video_stream)
+
+    @staticmethod
+    def _get_idle_timeout(camera_settings):
+        return camera_settings["idleTimeout"] if camera_settings != None and "idleTimeout" in camera_settings else IDLE_TIMEOUT
+
+    def manage_streams(self):
+        now = datetime.now()
+        for camera_settings in self.camera_settings:
+            camera_name = camera_settings["name"]
+            keep_alive = camera_settings["keepAlive"] if "keepAlive" in camera_settings else "idle"
+            idle_timeout = self._get_idle_timeout(camera_settings)
+            park_timeout = camera_settings["parkTimeout"] if "parkTimeout" in camera_settings else PARK_TIMEOUT
+            if keep_alive not in KEEP_ALIVE_POLICIES:
+                logger.warning("Unknown keepAlive policy %s for camera %s", keep_alive, camera_name)
+                keep_alive = "idle"
+            warm = keep_alive == "always" or (keep_alive == "schedule" and self._is_in_warm_window(camera_settings, now))
+            # Recorded streams always run and are never parked
+            recording = "recordPath" in camera_settings
+
+            stream = self.get_stream_by_name(camera_name)
+            if stream is None:
+                if recording:
+                    logger.info("Starting recorded camera stream %s", camera_name)
+                    self.start_decoding_camera_stream(camera_name, video_stream=self.get_video_stream(camera_name))
+                elif warm:
+                    logger.info("Starting parked camera stream %s", camera_name)
+                    self.start_decoding_camera_stream(camera_name, parked=True, video_stream=self.get_video_stream(camera_name))
+                continue
+            if recording:
+                # The recorder is a full resolution consumer
+                self.update_last_accessed_timestamp(camera_name, self.get_video_stream(camera_name))
+            if not stream["parked"]:
+                self._select_video_stream(stream, idle_timeout)
+            if recording:
+                continue
+            idle = (now - stream["last_accessed"]).total_seconds()
+            if idle > idle_timeout + park_timeout and not warm:
+                logger.info("Stopping camera stream %s", camera_name)
+                self.stop_decoding_camera_stream(camera_name)
+            elif idle > idle_timeout and self.park_camera_stream(camera_name):
+                logger.info("Parking camera stream %s", camera_name)
+
+    @staticmethod
+    def _is_in_warm_window(camera_settings, now):
+        warm_windows = camera_settings["warmWindows"] if "warmWindows" in camera_settings else []
+        current_time = now.strftime("%H:%M")
+        for (start, end) in warm_windows:
+            if start <= end and start <= current_time < end:
+                return True
+            # The window continues over midnight
+            if start > end and (current_time >= start or current_time < end):
+                return True
+        return False
+
     def is_stream_running(self, camera_name):
         return self.get_stream_by_name(camera_name) != None
 
-    def update_last_accessed_timestamp(self, camera_name):
+    def update_last_accessed_timestamp(self, camera_name, video_stream=None):
         stream = self.get_stream_by_name(camera_name)
         if stream is not None:
             stream["last_accessed"] = datetime.now()
+            if video_stream != None:
+                stream["video_stream_accessed"][video_stream] = stream["last_accessed"]
 
     def get_camera_settings_by_name(self, camera_name):
         for camera_settings in self.camera_settings:
@@ -1,57 +1,238 @@
-from queue import Full
+from queue import Empty, Full
 import av
 import logging
+from threading import Condition, Lock, RLock
 from SimpleQueue import SimpleQueue as Queue
-from datetime import datetime, time
+from lazy_frame import LazyFrame
+from gop_buffer import GopBuffer, GOP_BUFFER_SIZE
+import time
+from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+DECODE_BATCH_SIZE = 16
+DECODE_STATS_INTERVAL = 5
+
 class Decoder:
-    def __init__(self):
+    def __init__(self, executor, decode_on_demand=False, codec_threads=None, codec_thread_type=None, target_fps=None, gop_buffer_size=GOP_BUFFER_SIZE):
         self.codec = av.CodecContext.create('h264', 'r')
+        # Frame threading decodes more frames in parallel, but delays every frame by one frame per thread.
+        # Slice threading only helps if the camera encodes multiple slices per frame.
+        if codec_threads != None:
+            self.codec.thread_count = codec_threads
+        if codec_thread_type != None:
+            self.codec.thread_type = codec_thread_type.upper()
+        self.codec_lock = RLock()
         self.last_frame = None
+        # Every decoded frame gets the next sequence number, so consumers can tell whether a frame changed
+        self.frame_sequence = 0
+        # JPEG encodes per rendition of all frames of this decoder
+        self.jpeg_encodes = {}
+        # Every switch of the video stream starts a new generation with its first key frame.
+        # The parsed packets are numbered by their pts, the frames get the generation of their packet.
+        self.queued_generation = 0
+        self.parsed_generation = 0
+        self.packet_count = 0
+        self.generation_starts = [(0, 0)]
+        # Notified whenever a new frame was decoded or new data could be decoded on demand
+        self.frame_condition = Condition()
+        self.frame_updates = 0
         self.frame_callbacks = []
         self.queue = Queue(500)
-        self.running = False
+        # Decoding runs on a bounded executor shared by all cameras. At most one
+        # process() call per decoder is scheduled at a time, which keeps the order.
+        self.executor = executor
+        self.processing = False
+        self.processing_lock = Lock()
+        self.running = True
         self.last_data_queued = None
+        # While decoding on demand and nobody is subscribed, only the bitstream
+        # since the last I-frame is kept and decoded when a snapshot is requested
+        self.decode_on_demand = decode_on_demand
+        self.gop_lock = Lock()
+        self.gop_buffer = GopBuffer(gop_buffer_size)
+        self.gop_decoded_count = 0
+        # Frames are only dispatched to the frame callbacks at the target fps. While more frames
+        # than that are decoded, the codec also skips non-reference frames without decoding them.
+        self.frame_interval = 1 / target_fps if target_fps != None else None
+        self.next_dispatch_time = None
+        self.decode_stats = {
+            "decoded_frames": 0,
+            "dispatched_frames": 0,
+            "decode_time": 0,
+            "start": datetime.now(),
+        }
 
     def add_frame_callback(self, frame_callback):
-        self.frame_callbacks.append(frame_callback)
-    
+        with self.gop_lock:
+            self.frame_callbacks.append(frame_callback)
+            if self.decode_on_demand and len(self.frame_callbacks) == 1:
+                # Continue decoding the current GOP where the snapshot decoding stopped
+                for (data, generation) in self.gop_buffer.items[self.gop_decoded_count:]:
+                    self._queue_for_decoding(data, generation)
+                self.gop_buffer.clear()
+                self.gop_decoded_count = 0
+
     def remove_frame_callback(self, frame_callback):
-        self.frame_callbacks.remove(frame_callback)
-    
+        with self.gop_lock:
+            self.frame_callbacks.remove(frame_callback)
+
+    def is_decoding_on_demand(self):
+        return self.decode_on_demand and len(self.frame_callbacks) == 0
+
+    def get_last_frame(self):
+        if self.decode_on_demand:
+            self._decode_buffered_gop()
+        return self.last_frame
+
+    def wait_for_frame(self, after_sequence=0, timeout=None, generation=0):
+        '''Return the last frame as soon as its sequence number is greater than 'after_sequence'
+        and it is of the video stream 'generation' or a newer one.
+        Returns None if there is no such frame within 'timeout' seconds.
+        '''
+        deadline = time.monotonic() + timeout if timeout != None else None
+        while True:
+            with self.frame_condition:
+                frame_updates = self.frame_updates
+            last_frame = self.get_last_frame()
+            if last_frame != None and last_frame.sequence > after_sequence and last_frame.generation >= generation:
+                return last_frame
+            with self.frame_condition:
+                remaining = deadline - time.monotonic() if deadline != None else None
+                if remaining != None and remaining <= 0:
+                    return None
+                self.frame_condition.wait_for(lambda: self.frame_updates != frame_updates, remaining)
+
+    def _notify_frame_waiters(self):
+        with self.frame_condition:
+            self.frame_updates += 1
+            self.frame_condition.notify_all()
+
+    def _decode(self, data, generation=0):
+        with self.codec_lock:
+            packets = []
+            if generation != self.parsed_generation:
+                # The parser holds back the last access unit until more data arrives, it belongs to the previous stream
+                packets += self._parse(None)
+                self.generation_starts.append((self.packet_count, generation))
+                self.parsed_generation = generation
+            packets += self._parse(data)
+            frames = [frame for packet in packets for frame in self.codec.decode(packet) if frame.is_corrupt == False]
+            lazy_frames = [LazyFrame(frame, self.frame_sequence + i + 1, self.jpeg_encodes, self._get_generation(frame.pts)) for (i, frame) in enumerate(frames)]
+            self.frame_sequence += len(frames)
+            return lazy_frames
+
+    def _parse(self, data):
+        packets = [packet for packet in self.codec.parse(data) if packet.is_corrupt == False]
+        for packet in packets:
+            packet.pts = self.packet_count
+            self.packet_count += 1
+        return packets
+
+    def _get_generation(self, pts):
+        # Frames leave the codec in decoding order, once a frame of a newer generation
+        # was decoded, no frames of the older generations follow
+        while len(self.generation_starts) > 1 and pts >= self.generation_starts[1][0]:
+            self.generation_starts.pop(0)
+        return self.generation_starts[0][1]
+
+    def _decode_buffered_gop(self):
+        with self.codec_lock:
+            with self.gop_lock:
+                pending_data = self.gop_buffer.items[self.gop_decoded_count:]
+                self.gop_decoded_count = len(self.gop_buffer.items)
+            if len(pending_data) == 0:
+                return
+            timing = datetime.now()
+            # A generation starts with a key frame, so the GOP is of a single generation
+            (_, generation) = pending_data[0]
+            frames = self._decode(b''.join(data for (data, _) in pending_data), generation)
+            if len(frames) > 0:
+                self.last_frame = frames[len(frames)-1]
+                self._notify_frame_waiters()
+            logger.info("Decoded %d buffered frames on demand in %.4fs", len(frames), (datetime.now() - timing).total_seconds())
+
+    def _schedule_processing(self):
+        with self.processing_lock:
+            if self.processing or not self.running:
+                return
+            self.processing = True
+        self.executor.submit(self.process)
+
     def process(self):
-        self.running = True
-        logger.info("Decoder deamon started")
-        while self.running:
+        # Decode a limited batch and reschedule afterwards,
+        # so a busy camera doesn't starve the other cameras on the executor
+        for _ in range(DECODE_BATCH_SIZE):
+            if not self.running:
+                break
+            try:
+                (data, generation) = self.queue.get_nowait()
+            except Empty:
+                break
             try:
                 timing = datetime.now()
 
-                data = self.queue.get()
-                
-                time_acquire_lock = (datetime.now() - timing).total_seconds()
-                timing = datetime.now()
+                frames = self._decode(data, generation)
 
-                frames = [frame.to_image() for packet in self.codec.parse(data) if packet.is_corrupt == False for frame in self.codec.decode(packet) if frame.is_corrupt == False]
-                
                 time_parse_decode_frames = (datetime.now() - timing).total_seconds()
+                self._update_decode_stats(len(frames), time_parse_decode_frames)
                 timing = datetime.now()
 
                 if frames != None and len(frames) > 0:
-                    for frame_callback in self.frame_callbacks:
-                        frame_callback(frames)
+                    dispatch_frames = self._select_frames_to_dispatch(frames)
+                    self.decode_stats["dispatched_frames"] += len(dispatch_frames)
+                    if len(dispatch_frames) > 0:
+                        for frame_callback in self.frame_callbacks:
+                            frame_callback(dispatch_frames)
                     self.last_frame = frames[len(frames)-1]
+                    self._notify_frame_waiters()
 
                 time_dispatch_frames = (datetime.now() - timing).total_seconds()
-                logger.info("Process timing. Acquire Lock: %.4fs, Frame Decoding: %.4fs, Dispatch frames: %.4fs", time_acquire_lock, time_parse_decode_frames, time_dispatch_frames)
-                        
+                logger.debug("Process timing. Frame Decoding: %.4fs, Dispatch frames: %.4fs", time_parse_decode_frames, time_dispatch_frames)
+
             except Exception as ex:
                 logger.warning("Unexpected exception occured: %s, Traceback = ".format(str(ex)), exc_info=True)
-    
+        with self.processing_lock:
+            self.processing = False
+        if not self.queue.empty():
+            self._schedule_processing()
+
+    def _select_frames_to_dispatch(self, frames):
+        if self.frame_interval == None:
+            return frames
+        now = time.monotonic()
+        if self.next_dispatch_time == None or now >= self.next_dispatch_time + self.frame_interval:
+            self.next_dispatch_time = now
+        if now < self.next_dispatch_time:
+            # More frames are decoded than needed, the non-reference ones don't have to be decoded at all
+            self.codec.skip_frame = "NONREF"
+            return []
+        self.next_dispatch_time += self.frame_interval
+        self.codec.skip_frame = "DEFAULT"
+        # Only the newest frame of a batch is dispatched
+        return frames[len(frames)-1:]
+
+    def _update_decode_stats(self, frame_count, decode_time):
+        self.decode_stats["decoded_frames"] += frame_count
+        self.decode_stats["decode_time"] += decode_time
+        elapsed = (datetime.now() - self.decode_stats["start"]).total_seconds()
+        if elapsed >= DECODE_STATS_INTERVAL:
+            decoded_frames = self.decode_stats["decoded_frames"]
+            logger.info("Decoder stats: %.2fms decode time per frame, %.2f fps decoded, %.2f fps dispatched",
+                1000 * self.decode_stats["decode_time"] / decoded_frames if decoded_frames > 0 else 0,
+                decoded_frames / elapsed,
+                self.decode_stats["dispatched_frames"] / elapsed)
+            self.decode_stats["decoded_frames"] = 0
+            self.decode_stats["dispatched_frames"] = 0
+            self.decode_stats["decode_time"] = 0
+            self.decode_stats["start"] = datetime.now()
+
+    def get_gop_buffer_stats(self):
+        with self.gop_lock:
+            return self.gop_buffer.get_stats()
+
     def stop(self):
         self.running = False
-        self.queue._count.release()
 
     def _log_queued_time(self):
         #logger.debug("Decoder queue size %d", self.queue.qsize())
@@ -63,10 +244,29 @@ class Decoder:
         else:
             self.last_data_queued = datetime.now()
 
-    def queue_data(self, data):
+    def _buffer_gop_data(self, data, key_frame, generation):
+        self.gop_buffer.add((data, generation), len(data), key_frame)
+        # A new GOP starts or the GOP was dropped because it got too large
+        if key_frame or len(self.gop_buffer.items) == 0:
+            self.gop_decoded_count = 0
+
+    def queue_data(self, data, key_frame=False, generation=0):
+        # The data of a new video stream until its first key frame can't be decoded on its own
+        if key_frame and generation > self.queued_generation:
+            self.queued_generation = generation
+        if self.decode_on_demand:
+            with self.gop_lock:
+                if self.is_decoding_on_demand():
+                    if len(data) > 0:
+                        self._buffer_gop_data(data, key_frame, self.queued_generation)
+                        self._notify_frame_waiters()
+                    return
+        self._queue_for_decoding(data, self.queued_generation)
+
+    def _queue_for_decoding(self, data, generation):
         try:
-            self.queue.put(data)
+            self.queue.put((data, generation))
             self._log_queued_time()
         except Full:
             logger.info("Decoder queue size is FULL: %d", self.queue.qsize())
-
+        self._schedule_processing()
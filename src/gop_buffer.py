@@ -0,0 +1,51 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+GOP_BUFFER_SIZE = 8 * 1024 * 1024
+
+class GopBuffer():
+    '''Keeps the video data since the most recent key frame, so a new consumer can
+    start with that key frame right away instead of waiting for the next one.
+    At most 'max_size' bytes are kept. A GOP which grows beyond that is dropped
+    until the next key frame, its frames couldn't be decoded without the dropped start.
+    The owner has to serialize the calls.
+    '''
+
+    def __init__(self, max_size=GOP_BUFFER_SIZE):
+        self.max_size = max_size
+        self.items = []
+        self.size = 0
+        self.stats = {
+            "gops": 0,
+            "overflows": 0,
+            "peak_size": 0,
+        }
+
+    def add(self, item, size, key_frame=False):
+        if key_frame:
+            self.stats["gops"] += 1
+            self.clear()
+        if key_frame or len(self.items) > 0:
+            if self.size + size > self.max_size:
+                logger.info("GOP buffer exceeded %d bytes, waiting for the next key frame", self.max_size)
+                self.clear()
+                self.stats["overflows"] += 1
+                return
+            self.items.append(item)
+            self.size += size
+        self.stats["peak_size"] = max(self.stats["peak_size"], self.size)
+
+    def clear(self):
+        self.items = []
+        self.size = 0
+
+    def get_items(self):
+        return list(self.items)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["size"] = self.size
+        stats["max_size"] = self.max_size
+        stats["items"] = len(self.items)
+        return stats
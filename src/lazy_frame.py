@@ -0,0 +1,58 @@
+import io
+from threading import Lock
+
+# Named sizes a frame can be converted to, each one fits into the given box keeping the aspect ratio
+RENDITIONS = {
+    "thumb": (800, 474),
+    "720p": (1280, 720),
+    "full": None,
+}
+
+def rendition_size(width, height, size):
+    box = RENDITIONS[size]
+    if box == None:
+        return (width, height)
+    scale = min(box[0] / width, box[1] / height, 1)
+    return (max(1, round(width * scale)), max(1, round(height * scale)))
+
+def count_jpeg_encode(jpeg_encodes, size):
+    if jpeg_encodes != None:
+        jpeg_encodes[size] = jpeg_encodes.get(size, 0) + 1
+
+class LazyFrame:
+    '''Decoded video frame which keeps the native av.VideoFrame (YUV planes)
+    and only converts it to a PIL image or JPEG the first time a consumer asks for it.
+    Every rendition is scaled by libswscale and cached, so it is only produced once per frame.
+    Each JPEG encode is counted per rendition in 'jpeg_encodes', which is shared by all frames of a decoder.
+    The 'generation' tells which video stream of the camera the frame was decoded from.
+    '''
+    def __init__(self, video_frame, sequence=0, jpeg_encodes=None, generation=0):
+        self.video_frame = video_frame
+        self.sequence = sequence
+        self.generation = generation
+        self.jpeg_encodes = jpeg_encodes
+        self.width = video_frame.width
+        self.height = video_frame.height
+        self.conversion_lock = Lock()
+        self._images = {}
+        self._jpegs = {}
+
+    def to_image(self, size="full"):
+        with self.conversion_lock:
+            if size not in self._images:
+                (width, height) = rendition_size(self.width, self.height, size)
+                if (width, height) == (self.width, self.height):
+                    self._images[size] = self.video_frame.to_image()
+                else:
+                    self._images[size] = self.video_frame.reformat(width, height, 'rgb24', interpolation='AREA').to_image()
+            return self._images[size]
+
+    def to_jpeg(self, size="full"):
+        image = self.to_image(size)
+        with self.conversion_lock:
+            if size not in self._jpegs:
+                output = io.BytesIO()
+                image.save(output, 'JPEG')
+                self._jpegs[size] = output.getvalue()
+                count_jpeg_encode(self.jpeg_encodes, size)
+            return self._jpegs[size]
@@ -1,15 +1,20 @@
+import os
 import json
-import io
 import time
+import asyncio
 import logging
 import argparse
 import threading
 import platform
 from datetime import datetime
-from SimpleQueue import SimpleQueue as Queue, Empty
-from flask import Flask, send_file, request, Response, abort
-from PIL import Image
-from camera_stream_manager import CameraStreamManager
+from queue import Empty
+from flask import Flask, send_file, request, Response, abort, jsonify
+from camera_stream_manager import CameraStreamManager, VIDEO_STREAM_POLICIES
+from baichuan_control_layer import MAINSTREAM
+from lazy_frame import RENDITIONS
+from video_passthrough import CONTAINER_FORMATS
+from rtsp_server import RtspServer
+from recorder import find_recording, read_recording
 
 app = Flask(__name__)
 
@@ -23,103 +28,173 @@ def load_settings_from_file(filename):
 
 settings = load_settings_from_file("settings.json")
 camera_settings = settings["cameras"]
+decoder_threads = settings["decoderThreads"] if "decoderThreads" in settings else None
+rtsp_port = settings["rtspPort"] if "rtspPort" in settings else None
 
-camera_stream_manager = CameraStreamManager(camera_settings)
+camera_stream_manager = CameraStreamManager(camera_settings, decoder_threads)
 
 def stop_camera_daemon():
     global camera_stream_manager
     while True:
-        with camera_stream_manager.stream_lock:
-            for stream in camera_stream_manager.streams:
-                name = stream["name"]
-                last_accessed = stream["last_accessed"]
-                if (datetime.now() - last_accessed).total_seconds() > 30:
-                    logger.info("Stopping camera stream %s", name)
-                    camera_stream_manager.stop_decoding_camera_stream(name)
+        # Starts, parks and stops the camera streams according to their keepAlive policy
+        camera_stream_manager.manage_streams()
         time.sleep(5)
 
 stop_camera_daemon_thread = threading.Thread(target=stop_camera_daemon, name="StopCameraDaemon", daemon=True)
 stop_camera_daemon_thread.start()
 
-def start_camera_stream(name):
+def start_camera_stream(name, video_stream=MAINSTREAM):
     camera_stream_manager.update_last_accessed_timestamp(name)
     stream = None
     if not camera_stream_manager.is_stream_running(name):
-        stream = camera_stream_manager.start_decoding_camera_stream(name)
+        stream = camera_stream_manager.start_decoding_camera_stream(name, video_stream=video_stream)
     
     if stream is None:
-        stream = camera_stream_manager.get_stream_by_name(name)
+        # A parked stream only has to start the video again
+        stream = camera_stream_manager.resume_camera_stream(name)
+    # The same session switches between the main and the sub stream
+    camera_stream_manager.request_video_stream(name, video_stream)
     return stream
 
+if rtsp_port != None:
+    # The RTSP server runs on the camera event loop, which receives the video
+    rtsp_server = RtspServer(camera_stream_manager, start_camera_stream, rtsp_port)
+    asyncio.run_coroutine_threadsafe(rtsp_server.start(), camera_stream_manager.loop)
+
+def get_requested_size():
+    size = request.args.get('size')
+    if size is None:
+        # ?thumbnail is the older way to request the thumb rendition
+        size = "thumb" if request.args.get('thumbnail') != None else "full"
+    if size not in RENDITIONS:
+        abort(400)
+    return size
+
+def get_requested_video_stream(name, size="full"):
+    stream_policy = request.args.get('stream')
+    if stream_policy != None and stream_policy not in VIDEO_STREAM_POLICIES:
+        abort(400)
+    return camera_stream_manager.get_video_stream(name, stream_policy, size)
+
 @app.route('/api/v1/cameras/<name>/stream', methods=["GET"])
 def get_image_stream_from_camera(name):
-    stream = start_camera_stream(name)
+    size = get_requested_size()
+    video_stream = get_requested_video_stream(name, size)
+    stream = start_camera_stream(name, video_stream)
     
     if stream is None:
         abort(404)
-    decoder = stream["decoder"]
-    queue = Queue()
-    frame_callback = lambda x: queue.put(x)
-    decoder.add_frame_callback(frame_callback)
+    mjpeg_encoder = stream["mjpeg_encoders"][size]
+    # Frames of the previous video stream are skipped while the camera switches
+    generation = stream["video_stream_generation"]
+    cursor = mjpeg_encoder.subscribe(generation)
 
     def frame_generator():
+        nonlocal cursor
         try:
             
             frameCounter = 0
+            skippedFrameCounter = 0
             lasFrameSentTime = datetime.now()
             while True:
                 try:
-                    camera_stream_manager.update_last_accessed_timestamp(name)
+                    camera_stream_manager.update_last_accessed_timestamp(name, video_stream)
 
-                    frames = queue.get(timeout=15)
+                    (parts, next_cursor) = mjpeg_encoder.get_parts(cursor, timeout=15, generation=generation)
+                    skippedFrameCounter += next_cursor - cursor - len(parts)
+                    cursor = next_cursor
                     
-                    for frame in frames:
-                        output = io.BytesIO()
-                        frame.save(output, 'JPEG')
-                        length = output.tell()
-                        
-                        yield (b'--frame\r\n'
-                            b'Content-Type: image/jpeg\r\nContent-Length: ' + str(length).encode() + b'\r\n\r\n' + output.getvalue() + b'\r\n')
-                        
+                    for part in parts:
+                        yield part
 
-                    frameCounter += len(frames)
+                    frameCounter += len(parts)
 
                     elapsed = (datetime.now() - lasFrameSentTime).total_seconds()
                     if elapsed >= 1:
-                        logger.info("FPS approx: %.2f, Queue Size: %d", round(frameCounter/elapsed, 2), queue.qsize())
+                        logger.info("FPS approx: %.2f, Skipped frames: %d, Encodes per frame: %.2f", round(frameCounter/elapsed, 2), skippedFrameCounter, mjpeg_encoder.encodes_per_frame())
                         frameCounter = 0
+                        skippedFrameCounter = 0
                         lasFrameSentTime = datetime.now()
                 except Empty:
-                    time.sleep(0.1)
                     continue             
         finally:
-            decoder.remove_frame_callback(frame_callback)
+            mjpeg_encoder.unsubscribe()
     return Response(frame_generator(), mimetype='multipart/x-mixed-replace; boundary=frame')
 
+@app.route('/api/v1/cameras/<name>/video', methods=["GET"])
+def get_video_from_camera(name):
+    container_format = request.args.get('format', 'ts')
+    if container_format not in CONTAINER_FORMATS:
+        abort(400)
+    video_stream = get_requested_video_stream(name)
+    stream = start_camera_stream(name, video_stream)
+
+    if stream is None:
+        abort(404)
+    video_passthrough = stream["video_passthrough"]
+
+    def video_generator():
+        # The H.264 stream is only remuxed, every viewer starts at the last key frame
+        for data in video_passthrough.stream(container_format):
+            # Also refreshed while the camera doesn't send anything, like the MJPEG stream does
+            camera_stream_manager.update_last_accessed_timestamp(name, video_stream)
+            if len(data) > 0:
+                yield data
+    (_, mimetype, _) = CONTAINER_FORMATS[container_format]
+    return Response(video_generator(), mimetype=mimetype)
+
+@app.route('/api/v1/cameras/<name>/recording', methods=["GET"])
+def get_recording_of_camera(name):
+    camera_settings = camera_stream_manager.get_camera_settings_by_name(name)
+    if camera_settings is None or "recordPath" not in camera_settings:
+        abort(404)
+    start_time = request.args.get('time', type=int)
+    if start_time is None:
+        abort(400)
+    directory = os.path.join(camera_settings["recordPath"], name)
+    # Only the key frame index of one segment is read to find the start
+    recording = find_recording(directory, start_time)
+    if recording is None:
+        abort(404)
+    (segment, offset) = recording
+    return Response(read_recording(directory, segment, offset), mimetype='video/mp2t')
+
+@app.route('/api/v1/cameras/<name>/stats', methods=["GET"])
+def get_stats_of_camera(name):
+    stream = camera_stream_manager.get_stream_by_name(name)
+    if stream is None:
+        abort(404)
+    return jsonify({
+        "gopBuffers": {
+            "passthrough": stream["video_passthrough"].get_gop_buffer_stats(),
+            # Only buffered while decoding on demand
+            "decoder": stream["decoder"].get_gop_buffer_stats(),
+        },
+    })
+
 @app.route('/api/v1/cameras/<name>', methods=["GET"])
 def get_image_from_camera(name):
-    stream = start_camera_stream(name)
+    size = get_requested_size()
+    stream = start_camera_stream(name, get_requested_video_stream(name, size))
     
     if stream is None:
         abort(404)
     decoder = stream["decoder"]
 
-    thumbnail_requested = request.args.get('thumbnail') != None
-
-    i = 0
-    while i < 100:
-        last_frame = decoder.last_frame
-        if last_frame != None:
-            output = io.BytesIO()
-            last_frame_clone = last_frame.copy()
-            if thumbnail_requested:
-                last_frame_clone.thumbnail((800, 474), Image.ANTIALIAS)
-            last_frame_clone.save(output, 'JPEG')
-            output.seek(0)
-            return send_file(output, mimetype='image/jpeg')
+    # Wakes up as soon as the first frame of a cold stream is decoded,
+    # concurrent requests for the same camera all wait for the same frame
+    last_frame = decoder.wait_for_frame(0, stream["snapshot_timeout"], stream["video_stream_generation"])
+    if last_frame != None:
+        # The frame sequence number restarts with every stream, so the stream start is part of the ETag
+        etag = "%s-%d-%d-%s" % (name, stream["start_time"], last_frame.sequence, size)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
         else:
-            time.sleep(0.1)
-            i += 1
+            # Renditions are cached in the frame and shared by all requests
+            response = Response(last_frame.to_jpeg(size), mimetype='image/jpeg')
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
     backup_image = stream["backup_image"]
     if backup_image != None:
         return send_file(backup_image)
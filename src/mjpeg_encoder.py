@@ -0,0 +1,75 @@
+import logging
+from threading import Lock
+from ring_buffer import RingBuffer
+
+logger = logging.getLogger(__name__)
+
+MJPEG_BUFFER_CAPACITY = 16
+
+class MjpegEncoder:
+    def __init__(self, decoder, size="full", buffer_capacity=MJPEG_BUFFER_CAPACITY):
+        self.decoder = decoder
+        self.size = size
+        # The encoded frames are kept with the generation of their video stream
+        self.ring_buffer = RingBuffer(buffer_capacity)
+        self.subscriber_count = 0
+        self.subscriber_lock = Lock()
+        # Frames dispatched to this encoder and the JPEG encodes of its rendition
+        # at the time the first viewer subscribed
+        self.dispatched_frame_count = 0
+        self.jpeg_encodes_start = 0
+
+    def subscribe(self, generation=0):
+        '''Return the cursor of a new viewer, which only wants frames of the video stream 'generation' or a newer one.'''
+        with self.subscriber_lock:
+            self.subscriber_count += 1
+            # Only hook into the decoder while somebody is watching,
+            # so an idle stream does not pay for JPEG encoding
+            cursor = self.ring_buffer.cursor()
+            if self.subscriber_count == 1:
+                self.dispatched_frame_count = 0
+                self.jpeg_encodes_start = self._get_jpeg_encodes()
+                # The newest frame is encoded right away, so the viewer gets a picture without
+                # waiting for the next decoded frame. On demand it is decoded from the buffered GOP.
+                last_frame = self.decoder.get_last_frame()
+                if last_frame != None and last_frame.generation >= generation:
+                    self._encode_frames([last_frame])
+                self.decoder.add_frame_callback(self._encode_frames)
+                return cursor
+            # The viewer starts with the newest encoded frame
+            return max(cursor - 1, 0)
+
+    def unsubscribe(self):
+        with self.subscriber_lock:
+            self.subscriber_count -= 1
+            if self.subscriber_count == 0:
+                self.decoder.remove_frame_callback(self._encode_frames)
+
+    def get_parts(self, cursor, timeout=None, generation=0):
+        '''Frames of older generations than 'generation' are skipped.'''
+        (parts, next_cursor) = self.ring_buffer.get(cursor, timeout)
+        return ([part for (part_generation, part) in parts if part_generation >= generation], next_cursor)
+
+    def encodes_per_frame(self):
+        '''JPEG encodes of this rendition per frame dispatched to the viewers, since the first viewer subscribed.
+        The frames cache their JPEGs, so it stays at 1 regardless of the viewer count.
+        '''
+        if self.dispatched_frame_count == 0:
+            return 0
+        return (self._get_jpeg_encodes() - self.jpeg_encodes_start) / self.dispatched_frame_count
+
+    def _get_jpeg_encodes(self):
+        return self.decoder.jpeg_encodes.get(self.size, 0)
+
+    @staticmethod
+    def encode_frame(frame, size="full"):
+        jpeg = frame.to_jpeg(size)
+        return (b'--frame\r\n'
+            b'Content-Type: image/jpeg\r\nContent-Length: ' + str(len(jpeg)).encode() + b'\r\n\r\n' + jpeg + b'\r\n')
+
+    def _encode_frames(self, frames):
+        # Every subscriber reads the same immutable bytes objects from the ring buffer,
+        # so each frame is encoded exactly once regardless of the viewer count
+        for frame in frames:
+            self.ring_buffer.put((frame.generation, self.encode_frame(frame, self.size)))
+        self.dispatched_frame_count += len(frames)
@@ -0,0 +1,303 @@
+import io
+import os
+import stat
+import struct
+import logging
+import multiprocessing
+from ctypes import c_bool
+from queue import Empty, Full
+from threading import Condition, Lock, Thread
+from PIL import Image
+from decoder import Decoder
+from gop_buffer import GOP_BUFFER_SIZE
+from lazy_frame import rendition_size, count_jpeg_encode
+from shared_ring_buffer import SharedRingBuffer
+
+logger = logging.getLogger(__name__)
+
+DECODER_INPUT_BUFFER_SIZE = 8 * 1024 * 1024
+DECODER_OUTPUT_BUFFER_SIZE = 16 * 1024 * 1024
+SNAPSHOT_TIMEOUT = 2
+# How often the worker checks whether the proxy is still running while no records arrive
+PARENT_CHECK_INTERVAL = 1
+
+RECORD_DATA = 0
+RECORD_KEY_FRAME_DATA = 1
+RECORD_SNAPSHOT_REQUEST = 2
+RECORD_FRAME = 3
+RECORD_SNAPSHOT = 4
+RECORD_STOP = 5
+RECORD_GENERATION = 6
+# Frames and snapshots start with the frame sequence number and the video stream generation
+FRAME_HEADER_STRUCT = struct.Struct("<QQ")
+# Snapshot requests carry the sequence number of the newest frame the webserver already has,
+# so an unchanged frame isn't sent again, and the sequence number and generation the snapshot has to reach.
+# The worker answers as soon as it has decoded such a frame.
+SNAPSHOT_REQUEST_STRUCT = struct.Struct("<QQQ")
+# The data records which follow a generation record belong to that video stream generation
+GENERATION_STRUCT = struct.Struct("<Q")
+
+# The worker process is forked, spawning would import and run main.py again
+CONTEXT = multiprocessing.get_context("fork")
+
+class JpegFrame:
+    '''Frame which was decoded and JPEG encoded in a decoder process.
+    It offers the same conversions as the LazyFrame, other renditions
+    than the full size are scaled from the decoded JPEG and cached.
+    '''
+    def __init__(self, jpeg, sequence=0, jpeg_encodes=None, generation=0):
+        self.sequence = sequence
+        self.generation = generation
+        self.jpeg_encodes = jpeg_encodes
+        self._images = {}
+        self._jpegs = {"full": jpeg}
+        self.conversion_lock = Lock()
+        # The full size JPEG was encoded once in the decoder process
+        count_jpeg_encode(jpeg_encodes, "full")
+
+    def to_image(self, size="full"):
+        with self.conversion_lock:
+            if "full" not in self._images:
+                self._images["full"] = Image.open(io.BytesIO(self._jpegs["full"]))
+                self._images["full"].load()
+            if size not in self._images:
+                full_image = self._images["full"]
+                self._images[size] = full_image.resize(rendition_size(full_image.width, full_image.height, size), Image.BILINEAR)
+            return self._images[size]
+
+    def to_jpeg(self, size="full"):
+        if size in self._jpegs:
+            return self._jpegs[size]
+        image = self.to_image(size)
+        with self.conversion_lock:
+            if size not in self._jpegs:
+                output = io.BytesIO()
+                image.save(output, 'JPEG')
+                self._jpegs[size] = output.getvalue()
+                count_jpeg_encode(self.jpeg_encodes, size)
+            return self._jpegs[size]
+
+class _InlineExecutor:
+    def submit(self, fn, *args):
+        fn(*args)
+
+def _close_inherited_sockets():
+    # The fork inherits the listening sockets of the webserver and the RTSP server and the camera sockets.
+    # An orphaned worker holding them would keep their ports bound.
+    for fd in os.listdir("/dev/fd"):
+        try:
+            if stat.S_ISSOCK(os.fstat(int(fd)).st_mode):
+                os.close(int(fd))
+        except OSError:
+            continue
+
+def _run_decoder_process(parent_pid, input_ring, output_ring, frames_wanted, decode_on_demand, codec_threads, codec_thread_type, target_fps, gop_buffer_size, frame_sequence, generation):
+    _close_inherited_sockets()
+    decoder = Decoder(_InlineExecutor(), decode_on_demand, codec_threads, codec_thread_type, target_fps, gop_buffer_size)
+    # A restarted worker continues the sequence numbers of the previous one
+    decoder.frame_sequence = frame_sequence
+
+    def put_output(record_type, data=b''):
+        # The webserver fell behind, the record is dropped instead of stopping the worker
+        try:
+            output_ring.put(record_type, data)
+            return True
+        except Full:
+            logger.info("Decoder output buffer is FULL, dropping record %d", record_type)
+            return False
+
+    def send_frames(frames):
+        for frame in frames:
+            put_output(RECORD_FRAME, FRAME_HEADER_STRUCT.pack(frame.sequence, frame.generation) + frame.to_jpeg())
+
+    def send_snapshot(known_sequence, last_frame):
+        header = FRAME_HEADER_STRUCT.pack(last_frame.sequence, last_frame.generation)
+        if last_frame.sequence == known_sequence:
+            return put_output(RECORD_SNAPSHOT, header)
+        return put_output(RECORD_SNAPSHOT, header + last_frame.to_jpeg())
+
+    pending_snapshot_requests = []
+    while True:
+        try:
+            (record_type, data) = input_ring.get(timeout=PARENT_CHECK_INTERVAL)
+        except Empty:
+            if os.getppid() != parent_pid:
+                logger.info("Proxy process is gone, stopping the decoder process")
+                return
+            # Snapshots which didn't fit into the output buffer are sent again
+            (record_type, data) = (None, None)
+        if frames_wanted.value != (len(decoder.frame_callbacks) > 0):
+            if frames_wanted.value:
+                decoder.add_frame_callback(send_frames)
+            else:
+                decoder.remove_frame_callback(send_frames)
+        if record_type == RECORD_DATA or record_type == RECORD_KEY_FRAME_DATA:
+            decoder.queue_data(data, record_type == RECORD_KEY_FRAME_DATA, generation)
+        elif record_type == RECORD_GENERATION:
+            (generation, ) = GENERATION_STRUCT.unpack(data)
+        elif record_type == RECORD_SNAPSHOT_REQUEST:
+            pending_snapshot_requests.append(SNAPSHOT_REQUEST_STRUCT.unpack(data))
+        elif record_type == RECORD_STOP:
+            put_output(RECORD_STOP)
+            return
+        if len(pending_snapshot_requests) > 0:
+            last_frame = decoder.get_last_frame()
+            if last_frame != None:
+                for snapshot_request in list(pending_snapshot_requests):
+                    (known_sequence, after_sequence, after_generation) = snapshot_request
+                    if last_frame.sequence > after_sequence and last_frame.generation >= after_generation:
+                        if send_snapshot(known_sequence, last_frame):
+                            pending_snapshot_requests.remove(snapshot_request)
+
+class ProcessDecoder:
+    '''Decoder with the interface of the Decoder, which decodes and JPEG encodes
+    in a separate worker process, so multiple cameras can use multiple CPU cores.
+    The bitstream is passed to the worker and the JPEGs are passed back
+    through shared memory ring buffers.
+    '''
+    def __init__(self, decode_on_demand=False, codec_threads=None, codec_thread_type=None, target_fps=None, gop_buffer_size=GOP_BUFFER_SIZE):
+        self.last_frame = None
+        self.frame_callbacks = []
+        # JPEG encodes per rendition of all frames of this camera
+        self.jpeg_encodes = {}
+        self.running = True
+        self.decode_on_demand = decode_on_demand
+        # Generation of the video stream the worker gets the data of
+        self.queued_generation = 0
+        self.worker_args = (decode_on_demand, codec_threads, codec_thread_type, target_fps, gop_buffer_size)
+        # The input ring has a single writer, but data is queued by the camera
+        # and snapshots are requested by the webserver
+        self.input_lock = Lock()
+        self.frames_wanted = CONTEXT.RawValue(c_bool, False)
+        # Notified whenever a frame or snapshot arrived from the worker
+        self.frame_condition = Condition()
+        self.snapshot_count = 0
+        self.worker_restarts = 0
+        # A restarted worker can only decode from the next key frame on
+        self.waiting_for_key_frame = False
+        self._start_worker()
+        self.result_thread = Thread(target=self._dispatch_results, name="DecoderResultThread", daemon=True)
+        self.result_thread.start()
+
+    def _start_worker(self):
+        # Every worker gets new ring buffers, a dead worker may have left its records half written or read
+        self.input_ring = SharedRingBuffer(DECODER_INPUT_BUFFER_SIZE, CONTEXT)
+        self.output_ring = SharedRingBuffer(DECODER_OUTPUT_BUFFER_SIZE, CONTEXT)
+        frame_sequence = self.last_frame.sequence if self.last_frame != None else 0
+        self.worker_process = CONTEXT.Process(target=_run_decoder_process, args=(os.getpid(), self.input_ring, self.output_ring, self.frames_wanted) + self.worker_args + (frame_sequence, self.queued_generation), name="DecoderProcess", daemon=True)
+        self.worker_process.start()
+
+    def _restart_worker(self):
+        logger.error("Decoder process died with exit code %s, restarting it", self.worker_process.exitcode)
+        self.worker_process.join()
+        with self.input_lock:
+            # stop() sets 'running' before it puts the stop record, so a new worker gets that record
+            if self.running:
+                self.worker_restarts += 1
+                self.waiting_for_key_frame = True
+                self._start_worker()
+
+    def add_frame_callback(self, frame_callback):
+        self.frame_callbacks.append(frame_callback)
+        self.frames_wanted.value = True
+
+    def remove_frame_callback(self, frame_callback):
+        self.frame_callbacks.remove(frame_callback)
+        self.frames_wanted.value = len(self.frame_callbacks) > 0
+
+    def is_decoding_on_demand(self):
+        return self.decode_on_demand and len(self.frame_callbacks) == 0
+
+    def get_last_frame(self):
+        if len(self.frame_callbacks) > 0:
+            return self.last_frame
+        self.wait_for_frame(0, SNAPSHOT_TIMEOUT)
+        return self.last_frame
+
+    def wait_for_frame(self, after_sequence=0, timeout=None, generation=0):
+        '''Return the last frame as soon as its sequence number is greater than 'after_sequence'
+        and it is of the video stream 'generation' or a newer one.
+        Returns None if there is no such frame within 'timeout' seconds.
+        '''
+        with self.frame_condition:
+            if len(self.frame_callbacks) > 0:
+                is_frame_available = lambda: self.last_frame != None and self.last_frame.sequence > after_sequence and self.last_frame.generation >= generation
+            else:
+                # Nobody receives the decoded frames, ask the worker for its latest one
+                snapshot_count = self.snapshot_count
+                known_sequence = self.last_frame.sequence if self.last_frame != None else 0
+                if not self._put_input(RECORD_SNAPSHOT_REQUEST, SNAPSHOT_REQUEST_STRUCT.pack(known_sequence, after_sequence, generation)):
+                    return None
+                is_frame_available = lambda: self.snapshot_count != snapshot_count and self.last_frame.sequence > after_sequence and self.last_frame.generation >= generation
+            if not self.frame_condition.wait_for(is_frame_available, timeout):
+                return None
+            return self.last_frame
+
+    def get_gop_buffer_stats(self):
+        # The GOP buffer is kept in the worker process
+        return None
+
+    def queue_data(self, data, key_frame=False, generation=0):
+        if self.waiting_for_key_frame:
+            if not key_frame:
+                return
+            self.waiting_for_key_frame = False
+        if generation != self.queued_generation:
+            if not self._put_input(RECORD_GENERATION, GENERATION_STRUCT.pack(generation)):
+                return
+            self.queued_generation = generation
+        self._put_input(RECORD_KEY_FRAME_DATA if key_frame else RECORD_DATA, data)
+
+    def stop(self):
+        self.running = False
+        self._put_input(RECORD_STOP)
+
+    def _put_input(self, record_type, data=b''):
+        try:
+            with self.input_lock:
+                self.input_ring.put(record_type, data)
+            return True
+        except Full:
+            logger.info("Decoder input buffer is FULL")
+            return False
+
+    def _dispatch_results(self):
+        while True:
+            try:
+                (record_type, data) = self.output_ring.get(timeout=1)
+            except Empty:
+                (record_type, data) = (None, None)
+            if record_type == None:
+                if not self.worker_process.is_alive():
+                    if not self.running:
+                        break
+                    # Otherwise the camera would silently stop producing frames
+                    self._restart_worker()
+                continue
+            if record_type == RECORD_STOP:
+                break
+            (sequence, generation) = FRAME_HEADER_STRUCT.unpack_from(data)
+            jpeg = data[FRAME_HEADER_STRUCT.size:]
+            if record_type == RECORD_FRAME:
+                frame = self._get_frame(jpeg, sequence, generation)
+                for frame_callback in self.frame_callbacks:
+                    frame_callback([frame])
+                with self.frame_condition:
+                    self.last_frame = frame
+                    self.frame_condition.notify_all()
+            elif record_type == RECORD_SNAPSHOT:
+                with self.frame_condition:
+                    if len(jpeg) > 0:
+                        self.last_frame = self._get_frame(jpeg, sequence, generation)
+                    self.snapshot_count += 1
+                    self.frame_condition.notify_all()
+        self.worker_process.join()
+        logger.info("Decoder process stopped")
+
+    def _get_frame(self, jpeg, sequence, generation):
+        # A frame can arrive as a frame and as the answer to a pending snapshot request,
+        # the existing one keeps its cached renditions
+        last_frame = self.last_frame
+        if last_frame != None and last_frame.sequence == sequence:
+            return last_frame
+        return JpegFrame(jpeg, sequence, self.jpeg_encodes, generation)
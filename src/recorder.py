@@ -0,0 +1,287 @@
+import os
+import av
+import time
+import struct
+import logging
+from collections import deque
+from datetime import datetime
+from fractions import Fraction
+from queue import Empty, Full
+from threading import Thread
+from SimpleQueue import SimpleQueue as Queue
+from video_passthrough import get_parameter_sets, get_resolution
+
+logger = logging.getLogger(__name__)
+
+RECORD_SEGMENT_SECONDS = 60
+RECORD_QUEUE_SIZE = 1000
+RECORDING_READ_SIZE = 64 * 1024
+VIDEO_TIME_BASE = Fraction(1, 90000)
+SEGMENT_NAME_FORMAT = "%Y%m%d-%H%M%S"
+SEGMENT_EXTENSION = ".ts"
+INDEX_EXTENSION = ".idx"
+# Key frame index record: UTC time of the camera in seconds, byte offset in the segment
+INDEX_RECORD_STRUCT = struct.Struct("<IQ")
+TS_PACKET_SIZE = 188
+TS_PAT_PID = 0x0000
+# The mpegts muxer assigns its start pid to the first stream, which is the video
+TS_VIDEO_PID = 0x0100
+ADTS_HEADER_SIZE = 7
+ADTS_SAMPLE_RATES = [96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350]
+AAC_FRAME_SAMPLES = 1024
+
+def split_adts_frames(data):
+    '''Return the ADTS frames of an AAC stream as (frame, sample rate, channels).'''
+    frames = []
+    offset = 0
+    while offset + ADTS_HEADER_SIZE <= len(data):
+        if data[offset] != 0xFF or data[offset+1] & 0xF0 != 0xF0:
+            logger.debug("Invalid ADTS header, dropping %d bytes of audio", len(data) - offset)
+            break
+        sample_rate_index = (data[offset+2] >> 2) & 0x0F
+        channels = ((data[offset+2] & 0x01) << 2) | (data[offset+3] >> 6)
+        frame_size = ((data[offset+3] & 0x03) << 11) | (data[offset+4] << 3) | (data[offset+5] >> 5)
+        if frame_size < ADTS_HEADER_SIZE or sample_rate_index >= len(ADTS_SAMPLE_RATES):
+            break
+        frames.append((data[offset:offset+frame_size], ADTS_SAMPLE_RATES[sample_rate_index], channels))
+        offset += frame_size
+    return frames
+
+def list_segments(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(SEGMENT_EXTENSION))
+
+def find_recording(directory, utc_time):
+    '''Return the segment and the byte offset of the last key frame at or before 'utc_time'.
+    The segment names sort by their start time, so only the index of that segment is read.
+    Returns None if the recording starts after 'utc_time'.
+    '''
+    if not os.path.isdir(directory):
+        return None
+    segment_name = datetime.utcfromtimestamp(utc_time).strftime(SEGMENT_NAME_FORMAT) + SEGMENT_EXTENSION
+    segments = [name for name in list_segments(directory) if name <= segment_name]
+    if len(segments) == 0:
+        return None
+    segment = segments[len(segments)-1]
+    with open(os.path.join(directory, segment[:-len(SEGMENT_EXTENSION)] + INDEX_EXTENSION), 'rb') as index_file:
+        index = index_file.read()
+    offset = 0
+    for (key_frame_time, key_frame_offset) in INDEX_RECORD_STRUCT.iter_unpack(index[:len(index) - len(index) % INDEX_RECORD_STRUCT.size]):
+        if key_frame_time > utc_time:
+            break
+        offset = key_frame_offset
+    return (segment, offset)
+
+def read_recording(directory, segment, offset):
+    '''Generator which yields the recording from 'offset' in 'segment' up to the newest segment.'''
+    for name in list_segments(directory):
+        if name < segment:
+            continue
+        with open(os.path.join(directory, name), 'rb') as segment_file:
+            if name == segment:
+                segment_file.seek(offset)
+            while True:
+                data = segment_file.read(RECORDING_READ_SIZE)
+                if len(data) == 0:
+                    break
+                yield data
+
+class _SegmentFile:
+    '''MPEG-TS segment file, which indexes the key frames while the muxer writes it.
+    A key frame starts with a TS packet of the video pid with the random access indicator.
+    The muxer writes a PAT and PMT shortly before every key frame, the index points to the
+    last PAT before the key frame, so a reader which starts there knows the streams.
+    '''
+    def __init__(self, path, index_path):
+        self.file = open(path, 'wb')
+        self.index_file = open(index_path, 'wb')
+        self.size = 0
+        self.pending = b''
+        self.pat_offset = 0
+        # UTC times of the key frames which were muxed, but not written yet
+        self.key_frame_times = deque()
+
+    def write(self, data):
+        data = bytes(data)
+        self.file.write(data)
+        offset = self.size - len(self.pending)
+        self.size += len(data)
+        packets = self.pending + data
+        position = 0
+        while position + TS_PACKET_SIZE <= len(packets):
+            pid = ((packets[position+1] & 0x1F) << 8) | packets[position+2]
+            if pid == TS_PAT_PID:
+                self.pat_offset = offset + position
+            elif pid == TS_VIDEO_PID and self._is_random_access_point(packets, position) and len(self.key_frame_times) > 0:
+                self.index_file.write(INDEX_RECORD_STRUCT.pack(self.key_frame_times.popleft(), self.pat_offset))
+                # Readers of the current segment find the key frame right away
+                self.index_file.flush()
+            position += TS_PACKET_SIZE
+        self.pending = packets[position:]
+        return len(data)
+
+    @staticmethod
+    def _is_random_access_point(packets, position):
+        payload_unit_start = packets[position+1] & 0x40
+        adaptation_field = packets[position+3] & 0x20
+        return payload_unit_start and adaptation_field and packets[position+4] > 0 and packets[position+5] & 0x40
+
+    def close(self):
+        self.file.close()
+        self.index_file.close()
+
+class Recorder:
+    '''Records the H.264 video and the AAC audio of a camera into MPEG-TS segments,
+    which start with a key frame and are about 'segment_seconds' long. Every segment has
+    a key frame index with the UTC time of the camera and the byte offset of each key frame.
+    The segments are written on a separate thread, so the disk doesn't block the camera event loop.
+    Segments older than 'max_age' seconds and the oldest segments above 'max_size' bytes are deleted.
+    '''
+    def __init__(self, directory, segment_seconds=RECORD_SEGMENT_SECONDS, max_age=None, max_size=None):
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self.max_age = max_age
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        self.parser = av.CodecContext.create('h264', 'r')
+        self.queue = Queue(RECORD_QUEUE_SIZE)
+        self.segment_file = None
+        self.container = None
+        self.video_stream = None
+        self.audio_stream = None
+        self.segment_start = None
+        # SPS and PPS of the current segment
+        self.parameter_sets = None
+        self.resolution = (0, 0)
+        self.last_video_pts = -1
+        self.next_audio_pts = 0
+        self.last_utc_time = None
+        # Sample rate and channels of the last audio, a segment only gets an audio stream if it is known
+        self.audio_format = None
+        self.running = True
+        self.thread = Thread(target=self._run, name="RecorderThread", daemon=True)
+        self.thread.start()
+
+    def queue_data(self, video_data, audio_data, key_frame=False, utc_time=None):
+        try:
+            self.queue.put((time.monotonic(), video_data, audio_data, key_frame, utc_time))
+        except Full:
+            logger.info("Recorder queue is FULL, dropping data")
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        while self.running:
+            try:
+                item = self.queue.get(timeout=1)
+            except Empty:
+                continue
+            try:
+                self._record(*item)
+            except Exception:
+                logger.warning("Recording to %s failed, starting a new segment", self.directory, exc_info=True)
+                self._close_segment()
+        self._close_segment()
+        logger.info("Recorder for %s stopped", self.directory)
+
+    def _record(self, arrival_time, video_data, audio_data, key_frame, utc_time):
+        if key_frame and utc_time != None:
+            self.last_utc_time = utc_time
+        for packet in self.parser.parse(video_data):
+            parameter_sets = get_parameter_sets(bytes(packet)) if packet.is_keyframe else None
+            # A new segment also starts when the camera switched between the main and the sub stream
+            if packet.is_keyframe and (self.container is None or arrival_time - self.segment_start >= self.segment_seconds or self._is_stream_changed(parameter_sets)):
+                self._close_segment()
+                self._open_segment(arrival_time, bytes(packet), parameter_sets)
+            if self.container is None:
+                # Segments start with a key frame
+                continue
+            if packet.is_keyframe:
+                self.segment_file.key_frame_times.append(self.last_utc_time if self.last_utc_time != None else int(time.time()))
+            # The camera doesn't send timestamps for every frame, the arrival time is used instead
+            self.last_video_pts = max(self.last_video_pts + 1, int((arrival_time - self.segment_start) / VIDEO_TIME_BASE))
+            video_packet = av.Packet(bytes(packet))
+            video_packet.stream = self.video_stream
+            video_packet.time_base = VIDEO_TIME_BASE
+            video_packet.pts = self.last_video_pts
+            video_packet.dts = self.last_video_pts
+            video_packet.is_keyframe = packet.is_keyframe
+            self.container.mux(video_packet)
+        for (frame, sample_rate, channels) in split_adts_frames(audio_data):
+            self.audio_format = (sample_rate, channels)
+            if self.audio_stream is None or self.audio_stream.rate != sample_rate:
+                continue
+            self.next_audio_pts = max(self.next_audio_pts, int((arrival_time - self.segment_start) * sample_rate))
+            audio_packet = av.Packet(frame)
+            audio_packet.stream = self.audio_stream
+            audio_packet.time_base = Fraction(1, sample_rate)
+            audio_packet.pts = self.next_audio_pts
+            audio_packet.dts = self.next_audio_pts
+            self.container.mux(audio_packet)
+            self.next_audio_pts += AAC_FRAME_SAMPLES
+
+    def _is_stream_changed(self, parameter_sets):
+        # Key frames without an SPS keep the stream
+        return len(parameter_sets) > 0 and parameter_sets != self.parameter_sets
+
+    def _open_segment(self, arrival_time, key_frame, parameter_sets):
+        start_time = self.last_utc_time if self.last_utc_time != None else int(time.time())
+        name = datetime.utcfromtimestamp(start_time).strftime(SEGMENT_NAME_FORMAT)
+        while os.path.exists(os.path.join(self.directory, name + SEGMENT_EXTENSION)):
+            # A stream switch can start two segments within a second, the names have to stay in order
+            start_time += 1
+            name = datetime.utcfromtimestamp(start_time).strftime(SEGMENT_NAME_FORMAT)
+        self.segment_file = _SegmentFile(os.path.join(self.directory, name + SEGMENT_EXTENSION), os.path.join(self.directory, name + INDEX_EXTENSION))
+        self.container = av.open(self.segment_file, 'w', format='mpegts')
+        self.video_stream = self.container.add_stream('h264')
+        if self._is_stream_changed(parameter_sets):
+            self.parameter_sets = parameter_sets
+            self.resolution = get_resolution(key_frame)
+        (self.video_stream.width, self.video_stream.height) = self.resolution
+        self.video_stream.time_base = VIDEO_TIME_BASE
+        self.audio_stream = None
+        if self.audio_format != None:
+            (sample_rate, channels) = self.audio_format
+            # The ADTS headers are kept, the muxer takes the audio format from them
+            self.audio_stream = self.container.add_stream('aac', rate=sample_rate)
+            self.audio_stream.codec_context.layout = "mono" if channels == 1 else "stereo"
+        self.segment_start = arrival_time
+        self.last_video_pts = -1
+        self.next_audio_pts = 0
+        logger.info("Recording segment %s", name)
+
+    def _close_segment(self):
+        # The streams belong to the closed container, nothing is muxed until the next segment
+        self.video_stream = None
+        self.audio_stream = None
+        if self.container is None:
+            return
+        try:
+            self.container.close()
+        except Exception:
+            logger.warning("Closing the recording segment failed", exc_info=True)
+        self.segment_file.close()
+        self.container = None
+        self.segment_file = None
+        self._apply_retention()
+
+    def _apply_retention(self):
+        if self.max_age is None and self.max_size is None:
+            return
+        segments = list_segments(self.directory)
+        sizes = [os.path.getsize(os.path.join(self.directory, segment)) for segment in segments]
+        total_size = sum(sizes)
+        now = time.time()
+        # The newest segment is always kept
+        for (segment, size) in zip(segments[:-1], sizes):
+            path = os.path.join(self.directory, segment)
+            too_old = self.max_age != None and now - os.path.getmtime(path) > self.max_age
+            too_large = self.max_size != None and total_size > self.max_size
+            if not too_old and not too_large:
+                break
+            logger.info("Deleting recording segment %s", segment)
+            os.remove(path)
+            index_path = path[:-len(SEGMENT_EXTENSION)] + INDEX_EXTENSION
+            if os.path.exists(index_path):
+                os.remove(index_path)
+            total_size -= size
@@ -0,0 +1,41 @@
+from queue import Empty
+from threading import Condition
+
+class RingBuffer():
+    '''Fixed-capacity broadcast buffer.
+    A single writer puts items, every reader keeps its own cursor (the sequence
+    number of the next item it wants to read). Readers which fall more than
+    'capacity' items behind skip ahead to the newest item instead of
+    receiving stale ones, so memory stays bounded no matter how many readers
+    there are or how slow they are.
+    '''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._items = [None] * capacity
+        self._write_sequence = 0
+        self._condition = Condition()
+
+    def put(self, item):
+        with self._condition:
+            self._items[self._write_sequence % self.capacity] = item
+            self._write_sequence += 1
+            self._condition.notify_all()
+
+    def cursor(self):
+        '''Return a cursor pointing at the next item which will be put.'''
+        with self._condition:
+            return self._write_sequence
+
+    def get(self, cursor, timeout=None):
+        '''Return all items from 'cursor' up to the newest one and the updated cursor.
+        Blocks at most 'timeout' seconds and raises the Empty exception if no
+        new item was put within that time.
+        '''
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._write_sequence > cursor, timeout):
+                raise Empty
+            if self._write_sequence - cursor > self.capacity:
+                cursor = self._write_sequence - 1
+            items = [self._items[sequence % self.capacity] for sequence in range(cursor, self._write_sequence)]
+            return (items, self._write_sequence)
@@ -0,0 +1,378 @@
+import base64
+import random
+import struct
+import asyncio
+import logging
+from urllib.parse import urlparse, unquote, parse_qs
+from video_passthrough import split_nal_units, NAL_UNIT_TYPE_SPS, NAL_UNIT_TYPE_PPS
+from camera_stream_manager import VIDEO_STREAM_POLICIES
+
+logger = logging.getLogger(__name__)
+
+RTSP_PORT = 8554
+RTSP_METHODS = ["OPTIONS", "DESCRIBE", "SETUP", "PLAY", "TEARDOWN", "GET_PARAMETER"]
+RTSP_STATUS_TEXTS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    454: "Session Not Found",
+    455: "Method Not Valid in This State",
+    461: "Unsupported Transport",
+    501: "Not Implemented",
+    503: "Service Unavailable",
+}
+MAX_REQUEST_SIZE = 64 * 1024
+SESSION_TIMEOUT = 60
+RTP_PAYLOAD_TYPE = 96
+RTP_CLOCK_RATE = 90000
+# Keeps the RTP packets below the usual ethernet MTU
+RTP_MAX_PAYLOAD_SIZE = 1400
+RTP_HEADER_STRUCT = struct.Struct(">BBHII")
+INTERLEAVED_HEADER_STRUCT = struct.Struct(">cBH")
+NAL_UNIT_TYPE_AUD = 9
+NAL_UNIT_TYPE_FU_A = 28
+# Clients which don't read the interleaved RTP fast enough skip to the next key frame
+MAX_WRITE_BUFFER_SIZE = 2 * 1024 * 1024
+
+def packetize_access_unit(access_unit, max_payload_size=RTP_MAX_PAYLOAD_SIZE):
+    '''Return the RTP payloads of an Annex-B access unit.
+    NAL units which fit into a packet are sent as single NAL unit packets,
+    larger ones are fragmented into FU-A packets (RFC 6184).
+    '''
+    payloads = []
+    for nal_unit in split_nal_units(access_unit):
+        nal_unit_type = nal_unit[0] & 0x1F
+        if nal_unit_type == NAL_UNIT_TYPE_AUD:
+            continue
+        if len(nal_unit) <= max_payload_size:
+            payloads.append(nal_unit)
+            continue
+        fu_indicator = (nal_unit[0] & 0xE0) | NAL_UNIT_TYPE_FU_A
+        fragment_size = max_payload_size - 2
+        # The NAL unit header is replaced by the FU indicator and the FU header
+        for offset in range(1, len(nal_unit), fragment_size):
+            fu_header = nal_unit_type
+            if offset == 1:
+                fu_header |= 0x80
+            if offset + fragment_size >= len(nal_unit):
+                fu_header |= 0x40
+            payloads.append(bytes([fu_indicator, fu_header]) + nal_unit[offset:offset+fragment_size])
+    return payloads
+
+def create_sdp(camera_name, parameter_sets):
+    sps = None
+    pps = []
+    for nal_unit in split_nal_units(parameter_sets):
+        if nal_unit[0] & 0x1F == NAL_UNIT_TYPE_SPS:
+            sps = nal_unit
+        elif nal_unit[0] & 0x1F == NAL_UNIT_TYPE_PPS:
+            pps.append(nal_unit)
+    fmtp = "packetization-mode=1"
+    if sps != None:
+        fmtp += ";profile-level-id=%s" % sps[1:4].hex().upper()
+        fmtp += ";sprop-parameter-sets=%s" % ",".join(base64.b64encode(nal_unit).decode("ascii") for nal_unit in [sps] + pps)
+    lines = [
+        "v=0",
+        "o=- 0 0 IN IP4 0.0.0.0",
+        "s=%s" % camera_name,
+        "c=IN IP4 0.0.0.0",
+        "t=0 0",
+        "a=control:*",
+        "m=video 0 RTP/AVP %d" % RTP_PAYLOAD_TYPE,
+        "a=rtpmap:%d H264/%d" % (RTP_PAYLOAD_TYPE, RTP_CLOCK_RATE),
+        "a=fmtp:%d %s" % (RTP_PAYLOAD_TYPE, fmtp),
+        "a=control:trackID=0",
+    ]
+    return ("\r\n".join(lines) + "\r\n").encode("utf-8")
+
+class RtspServer:
+    '''Serves the H.264 stream of every camera at rtsp://<host>:<port>/<camera name>.
+    The access units of the VideoPassthrough are only packetized into RTP, so one
+    camera session is fanned out to any number of RTSP clients without decoding.
+    The server runs on the camera event loop, where the access units arrive.
+    '''
+    def __init__(self, camera_stream_manager, start_camera_stream, port=RTSP_PORT, host='0.0.0.0'):
+        self.camera_stream_manager = camera_stream_manager
+        self.start_camera_stream = start_camera_stream
+        self.port = port
+        self.host = host
+        self.server = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(lambda: RtspConnection(self), self.host, self.port)
+        logger.info("RTSP server listening on port %d", self.port)
+
+    def stop(self):
+        if self.server != None:
+            self.server.close()
+
+class RtspConnection(asyncio.Protocol):
+    '''One RTSP client connection with at most one session. RTP is sent interleaved
+    over the RTSP connection or over UDP, whichever the client asks for.
+    '''
+    def __init__(self, server):
+        self.server = server
+        self.loop = None
+        self.transport = None
+        self.buffer = b''
+        self.requests = asyncio.Queue()
+        self.request_task = None
+        self.camera_name = None
+        self.video_passthrough = None
+        self.video_stream = None
+        self.session_id = None
+        self.interleaved_channel = None
+        self.rtp_transport = None
+        self.rtcp_transport = None
+        self.playing = False
+        self.waiting_for_key_frame = True
+        self.sequence_number = random.randint(0, 0xFFFF)
+        self.ssrc = random.randint(0, 0xFFFFFFFF)
+        self.timestamp_offset = random.randint(0, 0xFFFFFFFF)
+        self.last_timestamp = None
+
+    def connection_made(self, transport):
+        self.loop = asyncio.get_running_loop()
+        self.transport = transport
+        self.request_task = self.loop.create_task(self._handle_requests())
+        logger.info("RTSP client %s connected", transport.get_extra_info("peername"))
+
+    def connection_lost(self, exc):
+        self._teardown()
+        self.request_task.cancel()
+        logger.info("RTSP client %s disconnected", self.transport.get_extra_info("peername"))
+
+    def data_received(self, data):
+        self.buffer += data
+        while len(self.buffer) > 0:
+            if self.buffer[:1] == b'$':
+                # RTCP receiver reports of the client, interleaved with the requests
+                if len(self.buffer) < INTERLEAVED_HEADER_STRUCT.size:
+                    return
+                (_, _, size) = INTERLEAVED_HEADER_STRUCT.unpack_from(self.buffer)
+                if len(self.buffer) < INTERLEAVED_HEADER_STRUCT.size + size:
+                    return
+                self.buffer = self.buffer[INTERLEAVED_HEADER_STRUCT.size + size:]
+                continue
+            header_end = self.buffer.find(b'\r\n\r\n')
+            if header_end == -1:
+                if len(self.buffer) > MAX_REQUEST_SIZE:
+                    logger.warning("RTSP request too large, closing the connection")
+                    self.transport.close()
+                return
+            lines = self.buffer[:header_end].decode("utf-8", "replace").split("\r\n")
+            headers = {}
+            for line in lines[1:]:
+                (key, _, value) = line.partition(":")
+                headers[key.strip().lower()] = value.strip()
+            content_length = int(headers["content-length"]) if "content-length" in headers else 0
+            if len(self.buffer) < header_end + 4 + content_length:
+                return
+            self.buffer = self.buffer[header_end + 4 + content_length:]
+            self.requests.put_nowait((lines[0].split(" "), headers))
+
+    async def _handle_requests(self):
+        while True:
+            (request_line, headers) = await self.requests.get()
+            cseq = headers["cseq"] if "cseq" in headers else "0"
+            if len(request_line) != 3:
+                self._send_response(cseq, 400)
+                continue
+            (method, url, _) = request_line
+            logger.debug("RTSP request %s %s", method, url)
+            try:
+                await self._handle_request(method, url, headers, cseq)
+            except Exception:
+                logger.warning("RTSP request %s %s failed", method, url, exc_info=True)
+                self._send_response(cseq, 503)
+
+    async def _handle_request(self, method, url, headers, cseq):
+        if method == "OPTIONS":
+            self._send_response(cseq, 200, {"Public": ", ".join(RTSP_METHODS)})
+        elif method == "DESCRIBE":
+            (stream, _) = await self._start_camera_stream(url)
+            if stream is None:
+                self._send_response(cseq, 404)
+                return
+            video_passthrough = stream["video_passthrough"]
+            # The SDP carries the SPS and PPS, which are only known after the first key frame
+            if not await self._wait_for_key_frame(video_passthrough, stream["snapshot_timeout"]):
+                self._send_response(cseq, 503)
+                return
+            sdp = create_sdp(stream["name"], video_passthrough.parameter_sets)
+            self._send_response(cseq, 200, {"Content-Base": url.rstrip("/") + "/", "Content-Type": "application/sdp"}, sdp)
+        elif method == "SETUP":
+            if self.session_id != None:
+                # Only the single video track can be set up
+                self._send_response(cseq, 455)
+                return
+            (stream, video_stream) = await self._start_camera_stream(url)
+            if stream is None:
+                self._send_response(cseq, 404)
+                return
+            transport = await self._setup_transport(headers["transport"] if "transport" in headers else "")
+            if transport is None:
+                self._send_response(cseq, 461)
+                return
+            self.camera_name = stream["name"]
+            self.video_passthrough = stream["video_passthrough"]
+            self.video_stream = video_stream
+            self.session_id = "%016X" % random.getrandbits(64)
+            self._send_response(cseq, 200, {"Transport": transport, "Session": "%s;timeout=%d" % (self.session_id, SESSION_TIMEOUT)})
+        elif method in ["PLAY", "TEARDOWN", "GET_PARAMETER"]:
+            session_id = headers["session"].split(";")[0] if "session" in headers else None
+            if method != "GET_PARAMETER" and (self.session_id is None or session_id != self.session_id):
+                self._send_response(cseq, 454)
+                return
+            response_headers = {"Session": self.session_id} if self.session_id != None else {}
+            if method == "PLAY":
+                self._play(url, cseq, response_headers)
+                return
+            if method == "TEARDOWN":
+                self._teardown()
+            elif self.camera_name != None:
+                # The keepalive of the client, also while the camera doesn't send anything
+                self.server.camera_stream_manager.update_last_accessed_timestamp(self.camera_name, self.video_stream)
+            self._send_response(cseq, 200, response_headers)
+        else:
+            self._send_response(cseq, 501)
+
+    async def _start_camera_stream(self, url):
+        '''Return the stream of the camera in the url and the requested video stream.
+        Like the HTTP endpoints the url accepts ?stream=main|sub|auto.
+        '''
+        parsed_url = urlparse(url)
+        camera_name = unquote(parsed_url.path).strip("/").split("/")[0]
+        query = parse_qs(parsed_url.query)
+        stream_policy = query["stream"][0] if "stream" in query else None
+        if stream_policy != None and stream_policy not in VIDEO_STREAM_POLICIES:
+            return (None, None)
+        video_stream = self.server.camera_stream_manager.get_video_stream(camera_name, stream_policy)
+        # Starting a stream forks the decoder process if decodeInProcess is set
+        stream = await asyncio.get_running_loop().run_in_executor(None, self.server.start_camera_stream, camera_name, video_stream)
+        return (stream, video_stream)
+
+    async def _wait_for_key_frame(self, video_passthrough, timeout):
+        if len(video_passthrough.parameter_sets) > 0:
+            return True
+        key_frame_received = asyncio.get_running_loop().create_future()
+        def handle_access_unit(access_unit):
+            if access_unit[2] and not key_frame_received.done():
+                key_frame_received.set_result(True)
+        video_passthrough.add_access_unit_callback(handle_access_unit)
+        try:
+            await asyncio.wait_for(key_frame_received, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            video_passthrough.remove_access_unit_callback(handle_access_unit)
+
+    async def _setup_transport(self, transport):
+        parameters = {}
+        for parameter in transport.split(",")[0].split(";"):
+            (key, _, value) = parameter.partition("=")
+            parameters[key.strip()] = value.strip()
+        if "RTP/AVP/TCP" in parameters or "interleaved" in parameters:
+            channels = parameters["interleaved"] if "interleaved" in parameters else "0-1"
+            self.interleaved_channel = int(channels.split("-")[0])
+            return "RTP/AVP/TCP;unicast;interleaved=%d-%d;ssrc=%08X" % (self.interleaved_channel, self.interleaved_channel + 1, self.ssrc)
+        if "client_port" in parameters and "multicast" not in parameters:
+            client_ports = [int(port) for port in parameters["client_port"].split("-")]
+            client_host = self.transport.get_extra_info("peername")[0]
+            loop = asyncio.get_running_loop()
+            (self.rtp_transport, _) = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(client_host, client_ports[0]))
+            # Nothing is sent on RTCP, but the client expects a server port for it
+            (self.rtcp_transport, _) = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(client_host, client_ports[len(client_ports)-1]))
+            server_ports = (self.rtp_transport.get_extra_info("sockname")[1], self.rtcp_transport.get_extra_info("sockname")[1])
+            return "RTP/AVP;unicast;client_port=%s;server_port=%d-%d;ssrc=%08X" % (parameters["client_port"], server_ports[0], server_ports[1], self.ssrc)
+        return None
+
+    def _play(self, url, cseq, response_headers):
+        if self.playing:
+            self._send_response(cseq, 200, response_headers)
+            return
+        # Access units arrive on this event loop as well, so nothing is missed between
+        # sending the access units since the last key frame and adding the callback
+        (access_units, _) = self.video_passthrough.subscribe()
+        rtp_info = "url=%s;seq=%d" % (url.rstrip("/") + "/trackID=0", self.sequence_number)
+        if len(access_units) > 0:
+            rtp_info += ";rtptime=%d" % self._rtp_timestamp(access_units[0][0], update=False)
+        response_headers["RTP-Info"] = rtp_info
+        response_headers["Range"] = "npt=0.000-"
+        self._send_response(cseq, 200, response_headers)
+        self.playing = True
+        for access_unit in access_units:
+            self._send_access_unit(access_unit)
+        self.video_passthrough.add_access_unit_callback(self._send_access_unit)
+        self.video_passthrough.add_close_callback(self._handle_stream_stopped)
+        if self.video_passthrough.closed:
+            self._handle_stream_stopped()
+        logger.info("RTSP client %s is playing camera %s", self.transport.get_extra_info("peername"), self.camera_name)
+
+    def _handle_stream_stopped(self):
+        # The client would wait for a stopped stream forever, it reconnects and starts the stream again
+        logger.info("Camera stream %s was stopped, closing the RTSP connection", self.camera_name)
+        self.loop.call_soon_threadsafe(self.transport.close)
+
+    def _teardown(self):
+        if self.playing:
+            self.video_passthrough.remove_access_unit_callback(self._send_access_unit)
+            self.video_passthrough.remove_close_callback(self._handle_stream_stopped)
+            self.playing = False
+        for udp_transport in [self.rtp_transport, self.rtcp_transport]:
+            if udp_transport != None:
+                udp_transport.close()
+        self.rtp_transport = None
+        self.rtcp_transport = None
+        self.interleaved_channel = None
+        self.session_id = None
+        self.waiting_for_key_frame = True
+
+    def _rtp_timestamp(self, arrival_time, update=True):
+        # The camera doesn't send timestamps for every frame, the arrival time is used instead
+        timestamp = int(arrival_time * RTP_CLOCK_RATE)
+        if self.last_timestamp != None:
+            timestamp = max(timestamp, self.last_timestamp + 1)
+        if update:
+            self.last_timestamp = timestamp
+        return (timestamp + self.timestamp_offset) & 0xFFFFFFFF
+
+    def _send_access_unit(self, access_unit):
+        (arrival_time, data, key_frame) = access_unit
+        if self.transport.is_closing():
+            return
+        if self.interleaved_channel != None and self.transport.get_write_buffer_size() > MAX_WRITE_BUFFER_SIZE:
+            if not self.waiting_for_key_frame:
+                logger.info("RTSP client %s fell behind, skipping to the next key frame", self.transport.get_extra_info("peername"))
+            self.waiting_for_key_frame = True
+            return
+        if self.waiting_for_key_frame:
+            # The following P-frames can't be decoded without the previous frames
+            if not key_frame:
+                return
+            self.waiting_for_key_frame = False
+        timestamp = self._rtp_timestamp(arrival_time)
+        payloads = packetize_access_unit(data)
+        interleaved_packets = []
+        for (index, payload) in enumerate(payloads):
+            # The marker bit is set on the last packet of an access unit
+            marker = 0x80 if index == len(payloads) - 1 else 0
+            packet = RTP_HEADER_STRUCT.pack(0x80, marker | RTP_PAYLOAD_TYPE, self.sequence_number, timestamp, self.ssrc) + payload
+            self.sequence_number = (self.sequence_number + 1) & 0xFFFF
+            if self.interleaved_channel != None:
+                interleaved_packets.append(INTERLEAVED_HEADER_STRUCT.pack(b'$', self.interleaved_channel, len(packet)) + packet)
+            else:
+                self.rtp_transport.sendto(packet)
+        if len(interleaved_packets) > 0:
+            self.transport.write(b''.join(interleaved_packets))
+        self.server.camera_stream_manager.update_last_accessed_timestamp(self.camera_name, self.video_stream)
+
+    def _send_response(self, cseq, status, headers={}, body=b''):
+        lines = ["RTSP/1.0 %d %s" % (status, RTSP_STATUS_TEXTS[status]), "CSeq: %s" % cseq, "Server: camera_proxy"]
+        for (key, value) in headers.items():
+            lines.append("%s: %s" % (key, value))
+        if len(body) > 0:
+            lines.append("Content-Length: %d" % len(body))
+        self.transport.write(("\r\n".join(lines) + "\r\n\r\n").encode("utf-8") + body)
@@ -0,0 +1,58 @@
+import ctypes
+import struct
+import multiprocessing
+from queue import Empty, Full
+
+RECORD_HEADER_STRUCT = struct.Struct("<II")
+
+class SharedRingBuffer():
+    '''Byte ring buffer in shared memory to pass records between two processes.
+    There must be exactly one writer process and one reader process. Each record is
+    a record type and a byte string, which is copied once into and once out of
+    the shared memory. Nothing is pickled and no pipe is involved.
+    '''
+
+    def __init__(self, capacity, context=multiprocessing):
+        self.capacity = capacity
+        self._buffer = context.RawArray(ctypes.c_char, capacity)
+        # Total bytes written and total bytes read. Each position is only
+        # changed by one side, the semaphore release/acquire orders the accesses.
+        self._positions = context.RawArray(ctypes.c_uint64, 2)
+        self._records = context.Semaphore(0)
+
+    def _write(self, buffer, position, data):
+        offset = position % self.capacity
+        first_part = min(len(data), self.capacity - offset)
+        buffer[offset:offset+first_part] = data[:first_part]
+        buffer[:len(data)-first_part] = data[first_part:]
+
+    def _read(self, buffer, position, size):
+        offset = position % self.capacity
+        first_part = min(size, self.capacity - offset)
+        return bytes(buffer[offset:offset+first_part]) + bytes(buffer[:size-first_part])
+
+    def put(self, record_type, data=b''):
+        '''Append a record without blocking, raises the Full exception if there is not enough space.'''
+        size = RECORD_HEADER_STRUCT.size + len(data)
+        write_position = self._positions[0]
+        if size > self.capacity - (write_position - self._positions[1]):
+            raise Full
+        buffer = memoryview(self._buffer).cast('B')
+        self._write(buffer, write_position, RECORD_HEADER_STRUCT.pack(record_type, len(data)))
+        self._write(buffer, write_position + RECORD_HEADER_STRUCT.size, memoryview(data).cast('B'))
+        self._positions[0] = write_position + size
+        self._records.release()
+
+    def get(self, timeout=None):
+        '''Remove and return the oldest record as (record_type, data).
+        Blocks at most 'timeout' seconds and raises the Empty exception if no
+        record was put within that time.
+        '''
+        if not self._records.acquire(True, timeout):
+            raise Empty
+        buffer = memoryview(self._buffer).cast('B')
+        read_position = self._positions[1]
+        (record_type, size) = RECORD_HEADER_STRUCT.unpack(self._read(buffer, read_position, RECORD_HEADER_STRUCT.size))
+        data = self._read(buffer, read_position + RECORD_HEADER_STRUCT.size, size)
+        self._positions[1] = read_position + RECORD_HEADER_STRUCT.size + size
+        return (record_type, data)
@@ -0,0 +1,232 @@
+import av
+import time
+import logging
+from fractions import Fraction
+from queue import Empty
+from threading import Lock
+from ring_buffer import RingBuffer
+from gop_buffer import GopBuffer, GOP_BUFFER_SIZE
+
+logger = logging.getLogger(__name__)
+
+PASSTHROUGH_BUFFER_CAPACITY = 256
+PASSTHROUGH_TIME_BASE = Fraction(1, 90000)
+NAL_UNIT_TYPE_SPS = 7
+NAL_UNIT_TYPE_PPS = 8
+ACCESS_UNIT_DELIMITER = b'\x00\x00\x00\x01\x09\xf0'
+
+# Query parameter value: (PyAV format, mimetype, muxer options)
+CONTAINER_FORMATS = {
+    "ts": ("mpegts", "video/mp2t", {}),
+    "mp4": ("mp4", "video/mp4", {"movflags": "frag_keyframe+empty_moov+default_base_moof"}),
+}
+# MPEG-TS carries the parameter sets in band, so players follow a switch between the main and the sub stream.
+# The init segment of fragmented MP4 can't describe the new stream, those viewers end and reconnect for a new one.
+END_ON_STREAM_SWITCH_FORMATS = ["mp4"]
+
+def split_nal_units(data):
+    '''Return the NAL units of an Annex-B byte stream without their start codes.'''
+    nal_units = []
+    start = data.find(b'\x00\x00\x01')
+    while start != -1:
+        start += 3
+        end = data.find(b'\x00\x00\x01', start)
+        nal_unit = data[start:end] if end != -1 else data[start:]
+        # A 4 byte start code leaves a zero byte at the end of the previous unit
+        nal_units.append(nal_unit.rstrip(b'\x00') if end != -1 else nal_unit)
+        start = end
+    return [nal_unit for nal_unit in nal_units if len(nal_unit) > 0]
+
+def get_parameter_sets(access_unit):
+    '''Return the SPS and PPS of a key frame access unit in Annex-B format.'''
+    return b''.join(b'\x00\x00\x00\x01' + nal_unit for nal_unit in split_nal_units(access_unit) if nal_unit[0] & 0x1F in (NAL_UNIT_TYPE_SPS, NAL_UNIT_TYPE_PPS))
+
+def get_resolution(access_unit):
+    '''Return the (width, height) of a key frame access unit.
+    A parser keeps the resolution of the first SPS it saw, so a new one is used.
+    '''
+    parser = av.CodecContext.create('h264', 'r')
+    # The access unit is only parsed once the parser sees the start of the next one
+    parser.parse(access_unit + ACCESS_UNIT_DELIMITER)
+    return (parser.width, parser.height)
+
+class _ContainerOutput:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+class VideoPassthrough:
+    '''Passes the H.264 stream of a camera on to viewers without decoding it.
+    The Annex-B data is only split into access units by the parser. The access
+    units since the last key frame are kept, so a new viewer starts with a key
+    frame right away, and every viewer remuxes the packets into its own container.
+    '''
+    def __init__(self, buffer_capacity=PASSTHROUGH_BUFFER_CAPACITY, gop_buffer_size=GOP_BUFFER_SIZE):
+        self.parser = av.CodecContext.create('h264', 'r')
+        self.ring_buffer = RingBuffer(buffer_capacity)
+        self.gop_lock = Lock()
+        self.gop_buffer = GopBuffer(gop_buffer_size)
+        self.width = None
+        self.height = None
+        # SPS and PPS of the last key frame in Annex-B format
+        self.parameter_sets = b''
+        # Called on the camera event loop with every access unit
+        self.access_unit_callbacks = []
+        # Set when the camera stream was stopped, the viewers end
+        self.closed = False
+        # Called by the thread which stopped the camera stream
+        self.close_callbacks = []
+
+    def close(self):
+        self.closed = True
+        for close_callback in list(self.close_callbacks):
+            close_callback()
+
+    def add_close_callback(self, close_callback):
+        self.close_callbacks.append(close_callback)
+
+    def remove_close_callback(self, close_callback):
+        self.close_callbacks.remove(close_callback)
+
+    def add_access_unit_callback(self, access_unit_callback):
+        self.access_unit_callbacks.append(access_unit_callback)
+
+    def remove_access_unit_callback(self, access_unit_callback):
+        self.access_unit_callbacks.remove(access_unit_callback)
+
+    def queue_data(self, data):
+        if len(data) == 0:
+            return
+        for packet in self.parser.parse(data):
+            # (arrival time, access unit, key frame)
+            access_unit = (time.monotonic(), bytes(packet), packet.is_keyframe)
+            with self.gop_lock:
+                if packet.is_keyframe:
+                    parameter_sets = get_parameter_sets(access_unit[1])
+                    if len(parameter_sets) > 0 and parameter_sets != self.parameter_sets:
+                        # The camera switched between the main and the sub stream
+                        (self.width, self.height) = get_resolution(access_unit[1])
+                        self.parameter_sets = parameter_sets
+                self.gop_buffer.add(access_unit, len(access_unit[1]), packet.is_keyframe)
+                self.ring_buffer.put(access_unit)
+            for access_unit_callback in list(self.access_unit_callbacks):
+                access_unit_callback(access_unit)
+
+    def subscribe(self):
+        '''Return the access units since the last key frame and the cursor for the following ones.'''
+        with self.gop_lock:
+            return (self.gop_buffer.get_items(), self.ring_buffer.cursor())
+
+    def get_gop_buffer_stats(self):
+        with self.gop_lock:
+            return self.gop_buffer.get_stats()
+
+    def get_access_units(self, cursor, timeout=None):
+        return self.ring_buffer.get(cursor, timeout)
+
+    def stream(self, container_format="ts", timeout=15):
+        '''Generator which yields the camera video remuxed into the container format.
+        An empty chunk is yielded whenever no video arrived within 'timeout' seconds,
+        so the viewer can keep the stream alive. It ends once the passthrough was closed
+        and for the END_ON_STREAM_SWITCH_FORMATS when the camera switched the video stream.
+        '''
+        (pyav_format, _, options) = CONTAINER_FORMATS[container_format]
+        (access_units, cursor) = self.subscribe()
+        while len(access_units) == 0 or not access_units[0][2]:
+            try:
+                (access_units, cursor) = self.get_access_units(cursor, timeout)
+            except Empty:
+                if self.closed:
+                    return
+                yield b''
+                continue
+            access_units = self._skip_to_key_frame(access_units)
+
+        # The container describes the video stream of the first key frame
+        with self.gop_lock:
+            (parameter_sets, width, height) = (self.parameter_sets, self.width, self.height)
+        first_parameter_sets = get_parameter_sets(access_units[0][1])
+        if len(first_parameter_sets) > 0 and first_parameter_sets != parameter_sets:
+            parameter_sets = first_parameter_sets
+            (width, height) = get_resolution(access_units[0][1])
+        output = _ContainerOutput()
+        container = av.open(output, 'w', format=pyav_format, options=options)
+        try:
+            video_stream = container.add_stream('h264')
+            video_stream.width = width
+            video_stream.height = height
+            video_stream.time_base = PASSTHROUGH_TIME_BASE
+            video_stream.codec_context.extradata = parameter_sets
+            start_time = access_units[0][0]
+            last_dts = -1
+            stream_switched = False
+            while True:
+                for (arrival_time, data, key_frame) in access_units:
+                    if key_frame and container_format in END_ON_STREAM_SWITCH_FORMATS:
+                        key_frame_parameter_sets = get_parameter_sets(data)
+                        if len(key_frame_parameter_sets) > 0 and key_frame_parameter_sets != parameter_sets:
+                            stream_switched = True
+                            break
+                    packet = av.Packet(data)
+                    packet.stream = video_stream
+                    packet.time_base = PASSTHROUGH_TIME_BASE
+                    # The camera doesn't send timestamps for every frame, the arrival time is used instead
+                    last_dts = max(last_dts + 1, int((arrival_time - start_time) / PASSTHROUGH_TIME_BASE))
+                    packet.pts = last_dts
+                    packet.dts = last_dts
+                    packet.is_keyframe = key_frame
+                    container.mux(packet)
+                data = output.pop()
+                if len(data) > 0:
+                    yield data
+                if stream_switched:
+                    logger.info("Camera switched the video stream, ending the %s viewer", container_format)
+                    # Closing writes the last fragment
+                    container.close()
+                    data = output.pop()
+                    if len(data) > 0:
+                        yield data
+                    return
+                try:
+                    (next_access_units, next_cursor) = self.get_access_units(cursor, timeout)
+                except Empty:
+                    if self.closed:
+                        return
+                    yield b''
+                    access_units = []
+                    continue
+                if next_cursor - cursor > len(next_access_units):
+                    # The viewer fell behind, the following P-frames can't be decoded without the skipped ones
+                    logger.info("Passthrough viewer skipped %d frames", next_cursor - cursor - len(next_access_units))
+                    next_access_units = self._skip_to_key_frame(next_access_units)
+                    while len(next_access_units) == 0:
+                        try:
+                            (next_access_units, next_cursor) = self.get_access_units(next_cursor, timeout)
+                        except Empty:
+                            if self.closed:
+                                return
+                            yield b''
+                            continue
+                        next_access_units = self._skip_to_key_frame(next_access_units)
+                access_units = next_access_units
+                cursor = next_cursor
+        finally:
+            try:
+                container.close()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _skip_to_key_frame(access_units):
+        for index in range(len(access_units)):
+            if access_units[index][2]:
+                return access_units[index:]
+        return []
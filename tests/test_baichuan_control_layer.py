@@ -0,0 +1,33 @@
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from baichuan_control_layer import BaichuanControlLayer
+
+# The byte wise implementation which the bulk XOR cipher replaced
+def byte_wise_xml_decrypt(message, offset):
+    xml_key = [0x1F, 0x2D, 0x3C, 0x4B, 0x5A, 0x69, 0x78, 0xFF]
+    result = b''
+    for i in range(len(message)):
+        val = (message[i] ^ xml_key[(i + offset) % 8]) ^ (offset & 0xFF)
+        result += bytes([val])
+    return result
+
+class XmlDecryptTest(unittest.TestCase):
+    def test_equals_byte_wise_implementation(self):
+        data = random.Random(5).randbytes(4200)
+        for offset in [0, 1, 7, 8, 255, 256, 1000, 0x12345678]:
+            for length in list(range(0, 70)) + [100, 1000, 4097]:
+                with self.subTest(offset=offset, length=length):
+                    message = data[:length]
+                    self.assertEqual(BaichuanControlLayer.xml_decrypt(message, offset), byte_wise_xml_decrypt(message, offset))
+
+    def test_round_trip(self):
+        message = b"<?xml version=\"1.0\" encoding=\"UTF-8\" ?>\n<body>\n<LoginUser version=\"1.1\">\n</LoginUser>\n</body>\n"
+        self.assertEqual(BaichuanControlLayer.xml_decrypt(BaichuanControlLayer.xml_decrypt(message, 42), 42), message)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,402 @@
+import os
+import re
+import sys
+import time
+import random
+import struct
+import asyncio
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import baichuan_udp_layer
+from baichuan_udp_layer import BaichuanUdpLayer, UDP_MESSAGE_ID_DISCOVERY, UDP_MESSAGE_ID_CTRL, UDP_MESSAGE_ID_ACK, ACK_STRUCT, ACK_HEADER_STRUCT, SEND_WINDOW_SIZE
+
+DISCOVERY_XML = b"<P2P>\n<C2D_C>\n<uid>95270000YGAKNWKJ</uid>\n<cli>\n<port>53211</port>\n</cli>\n<cid>4242</cid>\n<mtu>1350</mtu>\n<debug>0</debug>\n<p>WIN</p>\n</C2D_C>\n</P2P>\n"
+
+# Captured from the table based implementation which calc_crc replaced
+CRC_VECTORS = [
+    (b"", 0x00000000),
+    (b"\x00", 0x00000000),
+    (b"123456789", 0x2dfd2d88),
+    (bytes(range(256)), 0x2493092b),
+    (DISCOVERY_XML, 0x2c75cf3a),
+    (BaichuanUdpLayer.de_or_encrypt_udp_message(DISCOVERY_XML, 1234), 0x2ce08cc4),
+]
+
+class CalcCrcTest(unittest.TestCase):
+    def test_vectors(self):
+        for (message, crc) in CRC_VECTORS:
+            with self.subTest(length=len(message)):
+                self.assertEqual(BaichuanUdpLayer.calc_crc(message), crc)
+
+    def test_accepts_memoryview(self):
+        self.assertEqual(BaichuanUdpLayer.calc_crc(memoryview(b"123456789")), 0x2dfd2d88)
+
+# The byte wise implementations which the bulk XOR cipher and zlib.crc32 replaced
+UDP_KEY = [0x1f2d3c4b, 0x5a6c7f8d, 0x38172e4b, 0x8271635a, 0x863f1a2b, 0xa5c6f7d8, 0x8371e1b4, 0x17f2d3a5]
+
+def byte_wise_de_or_encrypt_udp_message(message, tid):
+    key = [key_word + tid for key_word in UDP_KEY]
+    result = b''
+    for x in range((len(message) + 3) // 4):
+        xor_key_word = key[x & 7]
+        for b in range(0, 4):
+            byte_index = x * 4 + b
+            result += bytes([(message[byte_index] ^ ((xor_key_word >> (b * 8)) & 0xFF)) & 0xFF])
+            if byte_index >= len(message) - 1:
+                return result
+    return result
+
+def make_crc_table():
+    # The original table held these words as 4 little endian bytes each
+    table = []
+    for index in range(256):
+        value = index
+        for _ in range(8):
+            value = (value >> 1) ^ 0xEDB88320 if value & 1 else value >> 1
+        table += list(value.to_bytes(4, 'little'))
+    return table
+
+CRC_TABLE = make_crc_table()
+
+def byte_wise_calc_crc(message):
+    r = 0
+    for i in range(len(message)):
+        offset = ((message[i] ^ r) & 0xFF) << 2
+        r = (CRC_TABLE[offset + 3] << 24 | CRC_TABLE[offset + 2] << 16 | CRC_TABLE[offset + 1] << 8 | CRC_TABLE[offset]) ^ (r >> 8)
+    return r
+
+EQUIVALENCE_LENGTHS = list(range(0, 70)) + [100, 1000, 4097]
+
+class ByteWiseEquivalenceTest(unittest.TestCase):
+    def setUp(self):
+        self.data = random.Random(5).randbytes(4200)
+
+    def test_de_or_encrypt_udp_message(self):
+        for tid in [0, 1, 1234, 4000, -1, -5000, 0xFFFFFFFF]:
+            for length in EQUIVALENCE_LENGTHS:
+                with self.subTest(tid=tid, length=length):
+                    message = self.data[:length]
+                    self.assertEqual(BaichuanUdpLayer.de_or_encrypt_udp_message(message, tid), byte_wise_de_or_encrypt_udp_message(message, tid))
+
+    def test_calc_crc(self):
+        # Messages are passed as slices of the receive buffer, at any offset
+        data = memoryview(self.data)
+        for offset in [0, 1, 3, 20]:
+            for length in EQUIVALENCE_LENGTHS:
+                with self.subTest(offset=offset, length=length):
+                    message = data[offset:offset+length]
+                    self.assertEqual(BaichuanUdpLayer.calc_crc(message), byte_wise_calc_crc(message))
+
+HOST = "127.0.0.1"
+CLIENT_ID = 4242
+DEVICE_SID = "95270000YGAKNWKJ"
+HEADER_STRUCT = struct.Struct("<iIIiI")
+
+def pack_discovery_message(xml, tid=1):
+    message = BaichuanUdpLayer.de_or_encrypt_udp_message(xml.encode("utf-8"), tid)
+    return HEADER_STRUCT.pack(UDP_MESSAGE_ID_DISCOVERY, len(message), 1, tid, BaichuanUdpLayer.calc_crc(message)) + message
+
+def unpack_discovery_message(data):
+    (_, size, _, tid, _) = HEADER_STRUCT.unpack_from(data)
+    return BaichuanUdpLayer.de_or_encrypt_udp_message(data[HEADER_STRUCT.size:HEADER_STRUCT.size+size], tid).decode("utf-8")
+
+def find_tag(xml, tag):
+    match = re.search("<%s>\\s*([^<]*?)\\s*</%s>" % (tag, tag), xml)
+    return match.group(1) if match != None else None
+
+class StandInCamera(asyncio.DatagramProtocol):
+    '''Answers the local discovery (C2D_C) after 'delay' seconds, unless it is silent.'''
+    def __init__(self, delay=0, silent=False):
+        self.delay = delay
+        self.silent = silent
+        self.requests = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, sender):
+        xml = unpack_discovery_message(data)
+        if "<C2D_C>" not in xml:
+            return
+        self.requests += 1
+        if not self.silent:
+            answer = pack_discovery_message("<P2P><D2C_C_R><did>77</did><cid>%s</cid></D2C_C_R></P2P>" % find_tag(xml, "cid"))
+            asyncio.get_running_loop().call_later(self.delay, self.transport.sendto, answer, (HOST, int(find_tag(xml, "port"))))
+
+class StandInRelay(asyncio.DatagramProtocol):
+    '''Answers the P2P query (C2M_Q) and the registration (C2R_C) after 'delay' seconds.
+    The registration is answered by the relay (R2C_T) and by the device itself (D2C_T) from its own socket.
+    '''
+    def __init__(self, delay=0, send_device_id=True):
+        self.delay = delay
+        self.send_device_id = send_device_id
+        self.messages = 0
+        self.device_transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, sender):
+        xml = unpack_discovery_message(data)
+        self.messages += 1
+        asyncio.get_running_loop().call_later(self.delay, self._answer, xml, sender)
+
+    def _answer(self, xml, sender):
+        (_, port) = self.transport.get_extra_info("sockname")
+        if "<C2M_Q>" in xml:
+            address = "<ip>%s</ip><port>%d</port>" % (HOST, port)
+            self.transport.sendto(pack_discovery_message("<P2P><M2C_Q_R><reg>%s</reg><relay>%s</relay><log>%s</log><t>%s</t></M2C_Q_R></P2P>" % (address, address, address, address)), sender)
+        elif "<C2R_C>" in xml:
+            cid = find_tag(xml, "cid")
+            (_, device_port) = self.device_transport.get_extra_info("sockname")
+            self.transport.sendto(pack_discovery_message("<P2P><R2C_T><dev><ip>%s</ip><port>%d</port></dev><cid>%s</cid><sid>555</sid></R2C_T></P2P>" % (HOST, device_port, cid)), sender)
+            if self.send_device_id:
+                self.device_transport.sendto(pack_discovery_message("<P2P><D2C_T><did>88</did><cid>%s</cid><sid>555</sid></D2C_T></P2P>" % cid), sender)
+
+class DiscoverDeviceTest(unittest.IsolatedAsyncioTestCase):
+    '''Races the local discovery against the P2P discovery with stand-in UDP servers for the camera and the relay.'''
+
+    async def asyncSetUp(self):
+        self.loop = asyncio.get_running_loop()
+        self.transports = []
+        self.layer = None
+
+    async def asyncTearDown(self):
+        if self.layer != None:
+            self.layer.close()
+        for transport in self.transports:
+            transport.close()
+
+    async def _start(self, camera, relay):
+        (camera_transport, _) = await self.loop.create_datagram_endpoint(lambda: camera, local_addr=(HOST, 0))
+        (relay_transport, _) = await self.loop.create_datagram_endpoint(lambda: relay, local_addr=(HOST, 0))
+        (relay.device_transport, _) = await self.loop.create_datagram_endpoint(asyncio.DatagramProtocol, local_addr=(HOST, 0))
+        self.transports += [camera_transport, relay_transport, relay.device_transport]
+        self.camera_address = camera_transport.get_extra_info("sockname")
+        self.device_address = relay.device_transport.get_extra_info("sockname")
+        patcher = mock.patch.multiple(baichuan_udp_layer,
+            BINDING_IFACE_IP=HOST,
+            DEVICE_DISCOVERY_PORT=self.camera_address[1],
+            P2P_RELAY_PORT=relay_transport.get_extra_info("sockname")[1],
+            P2P_RELAY_HOSTNAMES=["localhost"],
+            # The last known address lets the local discovery reach the stand-in camera without a broadcast
+            discovery_cache={DEVICE_SID: {"target_address": self.camera_address, "device_id": 77, "discovered": time.monotonic()}},
+            p2p_relay_cache={"hosts": [], "resolved": None})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.layer = BaichuanUdpLayer(DEVICE_SID, CLIENT_ID)
+        await self.layer.open()
+
+    async def _discover(self):
+        start = time.monotonic()
+        await self.layer.discover_device()
+        return time.monotonic() - start
+
+    async def test_relay_wins_if_the_camera_is_not_in_the_lan(self):
+        camera = StandInCamera(silent=True)
+        await self._start(camera, StandInRelay(delay=0.03))
+        elapsed = await self._discover()
+        self.assertEqual(self.layer.device_id, 88)
+        self.assertEqual(self.layer.connection_id, 555)
+        self.assertEqual(self.layer.target_address, self.device_address)
+        self.assertEqual(self.layer.timeout, 1)
+        # Trying the local discovery first took at least 5 unicast rounds of 0.2s
+        self.assertLess(elapsed, 0.5)
+        # The local discovery was cancelled
+        requests = camera.requests
+        await asyncio.sleep(0.5)
+        self.assertEqual(camera.requests, requests)
+
+    async def test_camera_wins_if_it_is_in_the_lan(self):
+        relay = StandInRelay(delay=0.3)
+        await self._start(StandInCamera(), relay)
+        elapsed = await self._discover()
+        self.assertEqual(self.layer.device_id, 77)
+        self.assertEqual(self.layer.connection_id, -1)
+        self.assertEqual(self.layer.target_address, self.camera_address)
+        self.assertEqual(self.layer.timeout, 30)
+        self.assertLess(elapsed, 0.2)
+        # The P2P discovery was cancelled, it would register after the answer of the relay.
+        # A query sent right before the camera answered may still wait in the socket.
+        await asyncio.sleep(0.1)
+        messages = relay.messages
+        await asyncio.sleep(0.7)
+        self.assertEqual(relay.messages, messages)
+
+    async def test_camera_wins_after_the_relay_answered(self):
+        # The relay already sent the device address and the connection id, but the device itself never answers
+        await self._start(StandInCamera(delay=0.15), StandInRelay(delay=0.01, send_device_id=False))
+        await self._discover()
+        self.assertEqual(self.layer.device_id, 77)
+        self.assertEqual(self.layer.connection_id, -1)
+        self.assertEqual(self.layer.target_address, self.camera_address)
+
+DEVICE_ID = 77
+
+def pack_ctrl_packet(packet_id, payload):
+    return HEADER_STRUCT.pack(UDP_MESSAGE_ID_CTRL, CLIENT_ID, 0, packet_id, len(payload)) + payload
+
+def pack_ack(packet_id, flags=b''):
+    return ACK_HEADER_STRUCT.pack(UDP_MESSAGE_ID_ACK, CLIENT_ID, 0, 0, packet_id, 0, len(flags)) + flags
+
+def ctrl_payload(packet_id):
+    return b"payload %d" % packet_id
+
+class StandInDevice(asyncio.DatagramProtocol):
+    '''Device side of an established session, records the ACKs and the CTRL packets the layer sends.'''
+    def __init__(self):
+        self.acknowledged_packet_ids = []
+        self.ctrl_packets = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, sender):
+        (udp_message_id, _, _, packet_id, _) = HEADER_STRUCT.unpack_from(data)
+        if udp_message_id == UDP_MESSAGE_ID_ACK:
+            self.acknowledged_packet_ids.append(ACK_STRUCT.unpack_from(data)[4])
+        elif udp_message_id == UDP_MESSAGE_ID_CTRL:
+            self.ctrl_packets.append((packet_id, time.monotonic()))
+
+class CtrlPacketTest(unittest.IsolatedAsyncioTestCase):
+    '''Exchanges CTRL packets and ACKs between the layer and a stand-in device.'''
+
+    async def asyncSetUp(self):
+        self.loop = asyncio.get_running_loop()
+        self.device = StandInDevice()
+        (self.transport, _) = await self.loop.create_datagram_endpoint(lambda: self.device, local_addr=(HOST, 0))
+        self.layer = None
+        self.delivered = []
+
+    async def asyncTearDown(self):
+        if self.layer != None:
+            self.layer.close()
+        self.transport.close()
+
+    async def _open(self, **kwargs):
+        with mock.patch.object(baichuan_udp_layer, "BINDING_IFACE_IP", HOST):
+            self.layer = BaichuanUdpLayer(DEVICE_SID, CLIENT_ID, **kwargs)
+        self.layer.device_id = DEVICE_ID
+        self.layer.target_address = self.transport.get_extra_info("sockname")
+        self.layer.set_packet_handler(lambda message: self.delivered.append(bytes(message)))
+        await self.layer.open()
+
+    def _send_ack(self, packet_id, flags=b''):
+        self.transport.sendto(pack_ack(packet_id, flags), self.layer.socket.getsockname())
+
+    def _sent_packet_ids(self):
+        return [packet_id for (packet_id, _) in self.device.ctrl_packets]
+
+    def _send(self, packet_ids):
+        # All datagrams are sent before the layer reads any of them, it receives them in this order
+        for packet_id in packet_ids:
+            self.transport.sendto(pack_ctrl_packet(packet_id, ctrl_payload(packet_id)), self.layer.socket.getsockname())
+
+    async def test_reordered_and_duplicated_packets_are_delivered_in_order(self):
+        await self._open(ack_every_packets=2, ack_delay_ms=200)
+        self._send([0, 2, 1, 1, 4, 3, 3, 5])
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.delivered, [ctrl_payload(packet_id) for packet_id in range(6)])
+        # Gaps, filled gaps and duplicates are acknowledged right away, the last packet after the delay
+        self.assertEqual(self.device.acknowledged_packet_ids, [0, 2, 2, 2, 4, 4])
+        await asyncio.sleep(0.25)
+        self.assertEqual(self.device.acknowledged_packet_ids, [0, 2, 2, 2, 4, 4, 5])
+        stats = self.layer.reorder_stats
+        self.assertEqual((stats["reordered_packets"], stats["gaps_filled"], stats["max_depth"]), (2, 2, 1))
+
+    async def test_shuffled_packets_are_delivered_in_order(self):
+        await self._open()
+        shuffler = random.Random(9)
+        packet_ids = list(range(100)) + shuffler.sample(range(100), 20)
+        shuffler.shuffle(packet_ids)
+        self._send(packet_ids)
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.delivered, [ctrl_payload(packet_id) for packet_id in range(100)])
+        self.assertEqual(self.layer.last_received_packet_id, 99)
+        self.assertEqual(len(self.layer.reordered_packets), 0)
+        self.assertGreater(self.layer.reorder_stats["max_depth"], 1)
+        self.assertEqual(self.device.acknowledged_packet_ids[-1], 99)
+
+    async def test_in_order_packets_are_acknowledged_once_after_the_delay(self):
+        await self._open(ack_every_packets=10, ack_delay_ms=100)
+        self._send([0, 1, 2])
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.device.acknowledged_packet_ids, [])
+        await asyncio.sleep(0.15)
+        self.assertEqual(self.device.acknowledged_packet_ids, [2])
+
+    async def test_every_n_packets_are_acknowledged_right_away(self):
+        await self._open(ack_every_packets=2, ack_delay_ms=1000)
+        self._send([0, 1, 2, 3])
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.device.acknowledged_packet_ids, [1, 3])
+
+    async def test_gap_is_acknowledged_right_away(self):
+        await self._open(ack_every_packets=10, ack_delay_ms=1000)
+        self._send([0, 2])
+        await asyncio.sleep(0.05)
+        # The camera learns about the missing packet 1 without waiting for the delay
+        self.assertEqual(self.device.acknowledged_packet_ids, [0])
+
+    async def test_partial_ack_retransmits_only_the_missing_packet(self):
+        await self._open()
+        for packet_id in range(5):
+            self.layer.send_packet(ctrl_payload(packet_id))
+        await asyncio.sleep(0.02)
+        self.assertEqual(self._sent_packet_ids(), [0, 1, 2, 3, 4])
+        # Packet 0 is acknowledged cumulatively, the flags cover the packets 1 to 4
+        self._send_ack(0, bytes([1, 0, 1, 1]))
+        await asyncio.sleep(0.02)
+        self.assertEqual(self._sent_packet_ids(), [0, 1, 2, 3, 4, 2])
+        self.assertEqual(list(self.layer.unack_messages), [2])
+        self.assertEqual(self.layer.retransmission_count, 1)
+
+    async def test_expired_rto_retransmits_with_exponential_backoff(self):
+        with mock.patch.object(baichuan_udp_layer, "INITIAL_RTO", 0.05):
+            await self._open()
+        self.layer.send_packet(ctrl_payload(0))
+        # Sent at 0s, retransmitted at 0.05s, 0.15s and 0.35s, the next one would follow at 0.75s
+        await asyncio.sleep(0.45)
+        self.assertEqual(self._sent_packet_ids(), [0, 0, 0, 0])
+        times = [send_time for (_, send_time) in self.device.ctrl_packets]
+        intervals = [later - earlier for (earlier, later) in zip(times, times[1:])]
+        # The RTO of 0.05s doubles with every retransmission
+        for (interval, rto) in zip(intervals, [0.05, 0.1, 0.2]):
+            self.assertGreaterEqual(interval, rto * 0.9)
+            self.assertLess(interval, rto + 0.04)
+        self.assertAlmostEqual(self.layer._retransmission_timeout(self.layer.unack_messages[0]), 0.4)
+        # Karn's algorithm: the round trip time of a retransmitted packet is ambiguous and not measured
+        self._send_ack(0)
+        await asyncio.sleep(0.02)
+        self.assertEqual(len(self.layer.unack_messages), 0)
+        self.assertEqual(self.layer.smoothed_rtt, None)
+        self.assertEqual(self.layer.rto, 0.05)
+
+    async def test_rto_follows_the_measured_round_trip_time(self):
+        await self._open()
+        self.layer.send_packet(ctrl_payload(0))
+        await asyncio.sleep(0.05)
+        self._send_ack(0)
+        await asyncio.sleep(0.02)
+        # RFC 6298: the first measurement R sets SRTT = R and RTTVAR = R/2, RTO = SRTT + 4 * RTTVAR
+        self.assertGreaterEqual(self.layer.smoothed_rtt, 0.05)
+        self.assertAlmostEqual(self.layer.rto, 3 * self.layer.smoothed_rtt)
+
+    async def test_send_window_blocks_the_sender(self):
+        await self._open()
+        for packet_id in range(SEND_WINDOW_SIZE + 36):
+            self.layer.send_packet(ctrl_payload(packet_id))
+        await asyncio.sleep(0.05)
+        self.assertEqual(self._sent_packet_ids(), list(range(SEND_WINDOW_SIZE)))
+        self.assertEqual(len(self.layer.send_queue), 36)
+        # Every acknowledged packet lets one queued packet into the window
+        self._send_ack(9)
+        await asyncio.sleep(0.05)
+        self.assertEqual(self._sent_packet_ids(), list(range(SEND_WINDOW_SIZE + 10)))
+        self.assertEqual(len(self.layer.unack_messages), SEND_WINDOW_SIZE)
+
+if __name__ == "__main__":
+    unittest.main()